@@ -1,55 +1,83 @@
-from utils.data_utils import st, load_data, format_currency, get_subscriptions_by_currency, compute_egp_financial_metrics, compute_total_students_count, compute_free_students_count, compute_non_churned_students_count, compute_churned_students_count, compute_churn_rate, compute_arpu_for_egp, plot_yearly_revenue_trends, plot_yearly_user_trends
+from utils.data_utils import st, format_currency
+from utils.kpis import load_kpi_snapshot
+from utils.financial_metrics import BASE_CURRENCY, load_financial_metrics
+from utils.trends import GRANULARITIES, load_trend_rollups, trend_date_range, load_revenue_trend, load_user_trend, plot_revenue_trends, plot_user_trends
+from utils.instrumentation import start_profile_run, render_debug_panel
+from utils.refresher import serve_snapshot
 
 st.set_page_config(page_title="Dashboard Overview", layout="wide", page_icon="📊")
+start_profile_run("overview")
+serve_snapshot()
 
 st.title("📊 Dashboard Overview")
 
-students_df, subscriptions_df = load_data()
-egp_subs = get_subscriptions_by_currency(subscriptions_df, 'egp')
+# Precomputed tables when `python -m utils.precompute` produced them for today's data, computed live otherwise
+kpi_snapshot = load_kpi_snapshot()
+financial_metrics = load_financial_metrics()
+trend_rollups = load_trend_rollups()
+
+# Every currency comes out of the same grouped pass, switching only picks another row
+currencies = financial_metrics['currencies']
+currency = st.sidebar.selectbox("Currency", currencies, index=currencies.index(BASE_CURRENCY) if BASE_CURRENCY in currencies else 0, format_func=str.upper)
+currency_totals = financial_metrics['totals'].loc[currency]
 
 # Revenue Metrics
 st.markdown("<style>div.row-widget.stColumn {margin-top: 20px;}</style>", unsafe_allow_html=True)
-st.subheader("Revenue Metrics - EGP Only")
-egp_financial_metrics  = compute_egp_financial_metrics (subscriptions_df)
+st.subheader(f"Revenue Metrics - {currency.upper()} Only")
 
 col1, col2, col3, col4 = st.columns(4)
-col1.metric("Total Revenue 💰", format_currency(egp_financial_metrics['total_revenue']))
-col2.metric("Net Revenue 📈", format_currency(egp_financial_metrics['net_revenue']))
-col3.metric("Remaining Amount ⏳", format_currency(egp_financial_metrics['remaining_amount']))
-col4.metric("Refund Amount ↩️", format_currency(egp_financial_metrics['refunded_amount']))
+col1.metric("Total Revenue 💰", format_currency(currency_totals['total_revenue'], currency))
+col2.metric("Net Revenue 📈", format_currency(currency_totals['net_revenue'], currency))
+col3.metric("Remaining Amount ⏳", format_currency(currency_totals['remaining_amount'], currency))
+col4.metric("Refund Amount ↩️", format_currency(currency_totals['refund_amount'], currency))
+
+# Consolidated totals, only with a local FX rate table
+consolidated = financial_metrics['consolidated']
+if consolidated is not None:
+    base_currency = consolidated['currency']
+    st.subheader(f"Revenue Metrics - All Currencies in {base_currency.upper()}")
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Total Revenue 💰", format_currency(consolidated['totals']['total_revenue'], base_currency))
+    col2.metric("Net Revenue 📈", format_currency(consolidated['totals']['net_revenue'], base_currency))
+    col3.metric("Remaining Amount ⏳", format_currency(consolidated['totals']['remaining_amount'], base_currency))
+    col4.metric("Refund Amount ↩️", format_currency(consolidated['totals']['refund_amount'], base_currency))
+    if consolidated['missing_rates']:
+        st.caption(f"No FX rate for {', '.join(code.upper() for code in consolidated['missing_rates'])}, left out of the consolidated totals.")
 
 # Student Metrics
 st.markdown("<style>div.row-widget.stColumn {margin-top: 20px;}</style>", unsafe_allow_html=True)
 st.subheader("Student Subscription Status")
-total_students_count = compute_total_students_count(students_df)
-free_students_count = compute_free_students_count(students_df)
-non_churned_students_counts = compute_non_churned_students_count(students_df)
-churned_students_counts = compute_churned_students_count(students_df)
 
 col5, col6, col7 = st.columns(3)
-col5.metric("✅ Active Students", non_churned_students_counts['active'])
-col6.metric("⚠️ Inactive Students", non_churned_students_counts['inactive'])
-col7.metric("⏳ Pending Students", non_churned_students_counts['pending'])
+col5.metric("✅ Active Students", kpi_snapshot.active_students)
+col6.metric("⚠️ Inactive Students", kpi_snapshot.inactive_students)
+col7.metric("⏳ Pending Students", kpi_snapshot.pending_students)
 
 col8, col9, col10 = st.columns(3)
-col8.metric("❌ Expired Students", churned_students_counts['expired'])
-col9.metric("🚫 Canceled Students", churned_students_counts['canceled'])
-col10.metric("🆓 Free Students", free_students_count)
+col8.metric("❌ Expired Students", kpi_snapshot.expired_students)
+col9.metric("🚫 Canceled Students", kpi_snapshot.canceled_students)
+col10.metric("🆓 Free Students", kpi_snapshot.free_students)
 
 # Business Snapshot
 st.markdown("<style>div.row-widget.stColumn {margin-top: 20px;}</style>", unsafe_allow_html=True)
 st.subheader('🚀 Business Snapshot')
 col11, col12, col13 =  st.columns(3)
-col11.metric("👥 Total Students", total_students_count)
-col12.metric("💵 ARPU",  format_currency(compute_arpu_for_egp(subscriptions_df)))
-col13.metric("📉 Churn Rate",  f"{compute_churn_rate(students_df):.2f}%")
+col11.metric("👥 Total Students", kpi_snapshot.total_students)
+col12.metric("💵 ARPU",  format_currency(currency_totals['arpu'], currency))
+col13.metric("📉 Churn Rate",  f"{kpi_snapshot.churn_rate:.2f}%")
 
 
-# Show time lines
-st.markdown("<style>div.row-widget.stColumn {margin-top: 20px;}</style>", unsafe_allow_html=True)
-plot_yearly_revenue_trends(egp_subs, 'EGP')
+# Show time lines, rolled up from the daily rollups to the chosen granularity and range
+granularity = st.sidebar.selectbox("Trend Granularity", list(GRANULARITIES), index=list(GRANULARITIES).index('Year'))
+first_day, last_day = trend_date_range(trend_rollups)
+trend_range = st.sidebar.date_input("Trend Date Range", value=(first_day, last_day), min_value=first_day, max_value=last_day)
+# Only the start is picked while the range is being edited
+trend_start, trend_end = trend_range if len(trend_range) == 2 else (trend_range[0], last_day)
 
 st.markdown("<style>div.row-widget.stColumn {margin-top: 20px;}</style>", unsafe_allow_html=True)
-plot_yearly_user_trends(students_df, subscriptions_df)
+plot_revenue_trends(load_revenue_trend(trend_rollups, currency, granularity, trend_start, trend_end), currency, granularity)
 
+st.markdown("<style>div.row-widget.stColumn {margin-top: 20px;}</style>", unsafe_allow_html=True)
+plot_user_trends(load_user_trend(trend_rollups, granularity, trend_start, trend_end), granularity)
 
+render_debug_panel()
@@ -0,0 +1,138 @@
+import argparse
+import json
+import logging
+import platform
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+# Cached helpers are not used here, silence the "no runtime" warnings of the Streamlit import
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+from benchmarks.synthetic_data import write_synthetic_data
+from utils.data_utils import pd, get_current_day, as_of_from_date, prepare_subscriptions_frame, build_cohort_base, cut_cohort_frames, get_percentage_pivot_for_same_cohort
+from utils.schema import STUDENTS_SCHEMA, SUBSCRIPTIONS_SCHEMA, compact_frame
+from utils.kpis import build_kpi_snapshot
+from utils.financial_metrics import FINANCIAL_SUBSCRIPTION_COLUMNS, build_financial_metrics, amounts_partial, merge_amounts_partials
+from utils.streaming import stream_aggregate
+from utils.student_dimensions import STUDENT_DIMENSIONS, build_student_dimensions
+from utils.cohort_pivots import FORECAST_PIVOTS, attach_student_attributes, build_forecast_pivots, update_forecast_pivots
+from utils.survival_forecast import build_survival_forecast
+from utils.trends import build_trend_rollups, trend_date_range, roll_up_revenue, roll_up_users
+from utils.filter_cube import ALL, build_filter_cube, lookup_rows_count, lookup_breakdown, lookup_pivot
+
+
+DEFAULT_SCALES = [1, 10, 100]
+
+
+def time_stage(results, name, function, repeats):
+    # Best of `repeats` runs, the result of the last run is returned for the next stages
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    results[name] = {'seconds': min(timings), 'runs': repeats}
+
+    return result
+
+def benchmark_scale(scale, data_dir, repeats, seed):
+    students_path, subscriptions_path = write_synthetic_data(data_dir, scale, seed)
+    stages = {}
+
+    # Loading
+    students_df = time_stage(stages, 'load.students', lambda: pd.read_parquet(students_path), repeats)
+    subscriptions_df = time_stage(stages, 'load.subscriptions', lambda: pd.read_parquet(subscriptions_path), repeats)
+    students_df = time_stage(stages, 'load.compact_students', lambda: compact_frame(students_df.copy(), STUDENTS_SCHEMA), repeats)
+    subscriptions_df = time_stage(stages, 'load.compact_subscriptions', lambda: compact_frame(subscriptions_df.copy(), SUBSCRIPTIONS_SCHEMA), repeats)
+
+    # Dashboard Overview (app.py)
+    time_stage(stages, 'overview.kpi_snapshot', lambda: build_kpi_snapshot(students_df, subscriptions_df), repeats)
+    time_stage(stages, 'overview.financial_metrics', lambda: build_financial_metrics(subscriptions_df), repeats)
+    trend_rollups = time_stage(stages, 'overview.trend_rollups', lambda: build_trend_rollups(students_df, subscriptions_df), repeats)
+    first_day, last_day = trend_date_range(trend_rollups)
+    time_stage(stages, 'overview.weekly_revenue_trend', lambda: roll_up_revenue(trend_rollups, 'egp', 'Week', first_day, last_day), repeats)
+    time_stage(stages, 'overview.weekly_user_trend', lambda: roll_up_users(trend_rollups, 'Week', first_day, last_day), repeats)
+    time_stage(stages, 'overview.streamed_amounts', lambda: stream_aggregate(
+        subscriptions_path, FINANCIAL_SUBSCRIPTION_COLUMNS, prepare_subscriptions_frame, amounts_partial, merge_amounts_partials,
+    ), repeats)
+
+    # Shared cohort preparation
+    as_of = get_current_day()
+    cohort_base = time_stage(stages, 'cohorts.cohort_base', lambda: build_cohort_base(subscriptions_df), repeats)
+    total_subs_df, renewed_df, churned_df = time_stage(stages, 'cohorts.cut_cohort_frames', lambda: cut_cohort_frames(cohort_base, as_of), repeats)
+    student_dimensions = time_stage(stages, 'cohorts.student_dimensions', lambda: build_student_dimensions(students_df, STUDENT_DIMENSIONS), repeats)
+
+    # Renewals Forecast (pages/00 subscriptions_analysis.py)
+    cohort_frames = {
+        'total_subs': total_subs_df,
+        'renewed': renewed_df,
+        'churned': churned_df,
+        'subs_with_info': time_stage(stages, 'forecast.attach_student_attributes', lambda: attach_student_attributes(total_subs_df, student_dimensions), repeats),
+    }
+    pivots = {}
+    for name, (function, frame, kwargs) in FORECAST_PIVOTS.items():
+        pivots[name] = time_stage(stages, f'forecast.pivot.{name}', lambda: function(cohort_frames[frame], **kwargs), repeats)
+    time_stage(stages, 'forecast.all_pivots', lambda: build_forecast_pivots(total_subs_df, renewed_df, churned_df, student_dimensions), repeats)
+    # Day roll: yesterday's pivots plus the rows that entered since, against the full build above
+    previous_as_of = as_of_from_date(as_of.date() - timedelta(days=1))
+    previous_pivots = build_forecast_pivots(*cut_cohort_frames(cohort_base, previous_as_of), student_dimensions)
+    time_stage(stages, 'forecast.day_roll_update', lambda: update_forecast_pivots(
+        previous_pivots, cut_cohort_frames(cohort_base, as_of), cut_cohort_frames(cohort_base, as_of, since=previous_as_of), student_dimensions
+    ), repeats)
+    time_stage(stages, 'forecast.survival_forecast', lambda: build_survival_forecast(cohort_base[0][0], as_of), repeats)
+    time_stage(stages, 'forecast.percentage_tables', lambda: [get_percentage_pivot_for_same_cohort(pivot) for pivot in pivots.values() if isinstance(pivot, pd.DataFrame)], repeats)
+
+    # Filter Viewer (pages/filters.py)
+    filter_cube = time_stage(stages, 'filters.filter_cube', lambda: build_filter_cube(total_subs_df, renewed_df, churned_df, student_dimensions), repeats)
+
+    def lookup_selections():
+        for cohort_month in [ALL] + filter_cube['cohort_months'][:12]:
+            for months_count in [ALL] + filter_cube['months_counts'][:6]:
+                if lookup_rows_count(filter_cube, 'Churn', cohort_month, months_count):
+                    lookup_breakdown(filter_cube, 'Churn', 'country', cohort_month, months_count)
+                    lookup_pivot(filter_cube, 'Churn', 'churned', cohort_month, months_count)
+
+    time_stage(stages, 'filters.lookups', lookup_selections, repeats)
+
+    return {
+        'scale': scale,
+        'students': len(students_df),
+        'subscriptions': len(subscriptions_df),
+        'stages': stages,
+    }
+
+def run_benchmarks(scales=DEFAULT_SCALES, repeats=3, seed=0):
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as data_dir:
+            result = benchmark_scale(scale, data_dir, repeats, seed)
+        total = sum(stage['seconds'] for stage in result['stages'].values())
+        print(f"scale {scale:>6}: {result['subscriptions']:>10,} subscriptions, {total:8.3f}s over {len(result['stages'])} stages")
+        results.append(result)
+
+    return {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'seed': seed,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every compute stage of the dashboards on synthetic data, without Streamlit rendering.')
+    parser.add_argument('--scales', type=float, nargs='+', default=DEFAULT_SCALES, help='size multipliers relative to the sample files')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.scales, args.repeats, args.seed)
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+SAMPLE_STUDENTS_PATH = 'students_sample.parquet'
+SAMPLE_SUBSCRIPTIONS_PATH = 'subscriptions_sample.parquet'
+
+
+def _segment_offsets(counts):
+    # 0..count-1 for every segment, concatenated
+    starts = np.cumsum(counts) - counts
+
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+def _export_month_ordinal(subscriptions_df):
+    # active_months / active_years in the export stop at the month the data was exported
+    months = subscriptions_df['active_months'].astype(str).str.extractall(r'\((\d{4}), (\d{1,2})\)').astype(int)
+
+    return int((months[0] * 12 + months[1] - 1).max())
+
+def _month_ordinals(timestamps):
+    return (timestamps.dt.year * 12 + timestamps.dt.month - 1).to_numpy()
+
+def _active_periods(activated_at, expired_at, export_month):
+    # Rebuilds active_years / active_months strings in the export format; formatted once per distinct month range
+    ranges = pd.DataFrame({
+        'first': _month_ordinals(activated_at),
+        'last': np.minimum(_month_ordinals(expired_at), export_month),
+    })
+    distinct = ranges.drop_duplicates().reset_index(drop=True)
+
+    active_months, active_years = [], []
+    for first, last in zip(distinct['first'], distinct['last']):
+        months = [(ordinal // 12, ordinal % 12 + 1) for ordinal in range(first, last + 1)]
+        active_months.append(str(months))
+        active_years.append(str(sorted({year for year, _ in months})))
+    distinct['active_months'] = active_months
+    distinct['active_years'] = active_years
+    distinct['active_months_count'] = (distinct['last'] - distinct['first'] + 1).clip(lower=0)
+
+    return ranges.merge(distinct, on=['first', 'last'], how='left')
+
+def _refresh_date_parts(df):
+    # *_year / *_month columns follow their (shifted) timestamp column, keeping the export dtypes
+    for column in df.select_dtypes('datetimetz').columns:
+        for part in ('year', 'month'):
+            part_column = f'{column}_{part}'
+            if part_column in df.columns:
+                values = getattr(df[column].dt, part)
+                df[part_column] = values.astype(df[part_column].dtype) if df[column].notna().all() else values.astype('float64')
+
+    return df
+
+
+def generate_synthetic_data(scale, seed=0, history_days=730, students_path=SAMPLE_STUDENTS_PATH, subscriptions_path=SAMPLE_SUBSCRIPTIONS_PATH):
+    # Every synthetic student copies a sampled student together with its whole subscription chain, shifted back in time
+    # by a random number of days. Status mix, currencies, plans, amounts and renewal chains follow the sample.
+    rng = np.random.default_rng(seed)
+    sample_students_df = pd.read_parquet(students_path)
+    sample_subscriptions_df = pd.read_parquet(subscriptions_path).sort_values(by=['student_id', 'created_at'], kind='stable')
+    export_month = _export_month_ordinal(sample_subscriptions_df)
+
+    students_count = int(round(len(sample_students_df) * scale))
+    templates = rng.integers(0, len(sample_students_df), students_count)
+    shifts = pd.to_timedelta(rng.integers(0, history_days + 1, students_count), unit='D')
+    student_ids = 'S-' + pd.Series(np.arange(1, students_count + 1)).astype(str)
+
+    students_df = sample_students_df.iloc[templates].reset_index(drop=True)
+    students_df['id'] = student_ids
+    for column in students_df.select_dtypes('datetimetz').columns:
+        students_df[column] = students_df[column] - shifts
+    students_df = _refresh_date_parts(students_df)
+
+    # Subscription chain of each template student
+    chain_sizes = sample_subscriptions_df.groupby('student_id').size()
+    chain_starts = chain_sizes.cumsum() - chain_sizes
+    template_ids = sample_students_df['id'].to_numpy()[templates]
+    chain_counts = chain_sizes.reindex(template_ids).fillna(0).astype('int64').to_numpy()
+    chain_rows = np.repeat(chain_starts.reindex(template_ids).fillna(0).astype('int64').to_numpy(), chain_counts) + _segment_offsets(chain_counts)
+
+    subscriptions_df = sample_subscriptions_df.iloc[chain_rows].reset_index(drop=True)
+    subscriptions_df['id'] = np.arange(1, len(subscriptions_df) + 1)
+    subscriptions_df['student_id'] = np.repeat(student_ids.to_numpy(), chain_counts)
+    subscription_shifts = np.repeat(shifts.to_numpy(), chain_counts)
+    for column in subscriptions_df.select_dtypes('datetimetz').columns:
+        subscriptions_df[column] = subscriptions_df[column] - subscription_shifts
+    subscriptions_df = _refresh_date_parts(subscriptions_df)
+
+    active_periods = _active_periods(subscriptions_df['activated_at'], subscriptions_df['expired_at'], export_month)
+    for column in ('active_months', 'active_years', 'active_months_count'):
+        subscriptions_df[column] = active_periods[column].astype(subscriptions_df[column].dtype).to_numpy()
+
+    return students_df, subscriptions_df
+
+def write_synthetic_data(output_dir, scale, seed=0):
+    students_df, subscriptions_df = generate_synthetic_data(scale, seed)
+    os.makedirs(output_dir, exist_ok=True)
+    students_path = os.path.join(output_dir, 'students.parquet')
+    subscriptions_path = os.path.join(output_dir, 'subscriptions.parquet')
+    students_df.to_parquet(students_path, index=False)
+    subscriptions_df.to_parquet(subscriptions_path, index=False)
+
+    return students_path, subscriptions_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate students/subscriptions tables shaped like the sample exports.')
+    parser.add_argument('--scale', type=float, default=10, help='size multiplier relative to the sample files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default='synthetic_data')
+    args = parser.parse_args()
+
+    students_path, subscriptions_path = write_synthetic_data(args.output_dir, args.scale, args.seed)
+    print(f'Wrote {students_path} and {subscriptions_path}')
+
+
+if __name__ == '__main__':
+    main()
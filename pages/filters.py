@@ -1,166 +1,144 @@
-from utils.data_utils import st, pd, aov, current_day, load_data
+from utils.data_utils import st, aov, select_as_of, get_data_version
+from utils.filter_cube import ALL, load_filter_cube, lookup_rows_count, lookup_breakdown, lookup_pivot
+from utils.cross_filter import load_cross_filter, select_rows, selection_rows_count, selection_breakdown, selection_pivot
+from utils.instrumentation import start_profile_run, render_debug_panel
+from utils.result_cache import cached_result
+from utils.refresher import serve_snapshot
 
 st.set_page_config(page_title="Filter Viewer", layout="wide", page_icon="🧮")
+start_profile_run("filter_viewer")
+serve_snapshot()
 st.title("🧮 Filter Viewer")
 
-students_df, subscriptions_df = load_data()
+# Every breakdown and pivot is precomputed per (subscription type, cohort month, months count), including the "All" roll-ups
+# Sidebar filters
+st.sidebar.subheader("Filters")
+as_of = select_as_of()
+filter_cube = load_filter_cube(as_of)
+subscription_type = st.sidebar.selectbox('Select Subscription Type', ['Retention', 'Churn'], index=0)
+cohort_month = st.sidebar.selectbox('Select Cohort Month', ['All Cohort Months'] + filter_cube['cohort_months'], index=0)
+months_count = st.sidebar.selectbox('Select Months Count from Subscription', ['All Months in Cohort'] + filter_cube['months_counts'], index=0)
+
+# "All" options remove the corresponding filter
+cohort_key = ALL if cohort_month == 'All Cohort Months' else cohort_month
+months_key = ALL if months_count == 'All Months in Cohort' else months_count
+
+# Cross filters: several values of one column match any of them, columns are combined
+cross_filter = load_cross_filter(as_of)
+cross_filter_labels = {
+    'country': 'Country',
+    'plan': 'Plan',
+    'currency': 'Currency',
+    'last_or_current_tutor': 'Tutor',
+    'last_or_current_grade_and_module': 'Grade & Module',
+}
+filters = {column: st.sidebar.multiselect(label, cross_filter['options'][column]) for column, label in cross_filter_labels.items()}
+
+# Without cross filters every table comes from the precomputed cube, otherwise from the rows selected by the bitmap indexes
+if any(filters.values()):
+    selections = {}
+
+    def selection():
+        # Rows are only selected when one of the tables is not cached yet
+        if 'rows' not in selections:
+            selections['rows'] = select_rows(cross_filter, subscription_type, filters, cohort_key, months_key)
+        return selections['rows']
+
+    def compute_rows_count():
+        return selection_rows_count(selection())
+
+    def compute_breakdown(column):
+        return selection_breakdown(selection(), column)
+
+    def compute_pivot(name):
+        return selection_pivot(selection(), name)
+else:
+    def compute_rows_count():
+        return lookup_rows_count(filter_cube, subscription_type, cohort_key, months_key)
 
-subscriptions_df['subscribed_at'] = subscriptions_df.groupby('student_id')['created_at'].transform('min')
-subscriptions_df = subscriptions_df.sort_values(by=['student_id', 'expired_at'])
+    def compute_breakdown(column):
+        return lookup_breakdown(filter_cube, subscription_type, column, cohort_key, months_key)
 
-# Prepare total subscriptions
-total_subs_df = subscriptions_df.copy()
-total_subs_df['cohort_month'] = total_subs_df['expired_at']
-total_subs_df['months_count_from_subscription'] = (((total_subs_df['expired_at'] - total_subs_df['subscribed_at']).dt.days) / 30).round()
-total_subs_df = total_subs_df[total_subs_df['cohort_month'] < current_day]
-total_subs_df['cohort_month'] = total_subs_df['expired_at'].dt.to_period('M')
+    def compute_pivot(name):
+        return lookup_pivot(filter_cube, subscription_type, name, cohort_key, months_key)
 
-# Prepare renewed subscriptions
-renewed_df = subscriptions_df.copy()
-renewed_df['cohort_month'] = renewed_df.groupby('student_id')['expired_at'].shift(1)
-renewed_df['months_count_from_subscription'] = (((renewed_df['cohort_month'] - renewed_df['subscribed_at']).dt.days) / 30).round()
-renewed_df = renewed_df[renewed_df['cohort_month'] < current_day]
-renewed_df['cohort_month'] = renewed_df['cohort_month'].dt.to_period('M')
+# Tables of a selection are computed once for every session, until the data files change or they are evicted
+data_version = get_data_version()
+selection_params = {
+    'as_of': as_of, 'subscription_type': subscription_type, 'cohort_month': cohort_key, 'months_count': months_key, 'filters': filters,
+}
 
-# Prepare churned subscriptions
-churned_df = subscriptions_df.copy()
-churned_df = churned_df.groupby('student_id').last().reset_index()
-churned_df = churned_df[churned_df['expired_at'] < current_day]
-churned_df['cohort_month'] = churned_df['expired_at'].dt.to_period('M')
-churned_df['months_count_from_subscription'] = (((churned_df['expired_at'] - churned_df['subscribed_at']).dt.days) / 30).round()
+def cached_table(table, compute):
+    return cached_result('filter_viewer', data_version, {**selection_params, 'table': table}, compute)
 
-# Sidebar filters
-st.sidebar.subheader("Filters")
-subscription_type = st.sidebar.selectbox('Select Subscription Type', ['Retention', 'Churn'], index=0)
-cohort_months_sorted = sorted(total_subs_df['cohort_month'].unique())
-cohort_month = st.sidebar.selectbox('Select Cohort Month', ['All Cohort Months'] + cohort_months_sorted, index=0)
-months_count_sorted = sorted(total_subs_df['months_count_from_subscription'].unique())
-months_count = st.sidebar.selectbox('Select Months Count from Subscription', ['All Months in Cohort'] + months_count_sorted, index=0)
+def breakdown(column):
+    return cached_table(('breakdown', column), lambda: compute_breakdown(column))
+
+def pivot(name):
+    return cached_table(('pivot', name), lambda: compute_pivot(name))
+
+rows_count = cached_table('rows_count', compute_rows_count)
 
 # Filter data
 if subscription_type == 'Retention':
-    # If "All Cohort Months" is selected, remove the cohort_month filter
-    if cohort_month == 'All Cohort Months':
-        filtered_data = renewed_df
-    else:
-        filtered_data = renewed_df[renewed_df['cohort_month'] == cohort_month]
-    
-    # If "All Months in Cohort" is selected, remove the months_count filter
-    if months_count == 'All Months in Cohort':
-        filtered_data = filtered_data
-    else:
-        filtered_data = filtered_data[filtered_data['months_count_from_subscription'] == months_count]
-    
-    # filtered_data = filtered_data[['student_id', 'subscribed_at', 'expired_at', 'currency', 'paid_amount', 'plan']]
-
     st.subheader(f"📊 Retention for Cohort {cohort_month} - Months Count {months_count}")
-    if filtered_data.empty:
+    if rows_count == 0:
         st.info("No data available for this filter combination.")
     else:
-        # st.write(filtered_data[['student_id', 'subscribed_at', 'expired_at', 'currency', 'paid_amount', 'plan']])
-
         # Country distribution for retention
-        country_table = students_df[students_df['id'].isin(filtered_data['student_id'])] \
-            .groupby('country')['id'].count().reset_index(name='count')
-        country_table = country_table.sort_values(by='count', ascending=False)
         st.write("🎓 Country Distribution")
-        st.write(country_table.set_index('country').T)
+        st.write(breakdown('country'))
 
         # Currency distribution for retention
-        currency_table = filtered_data.groupby('currency')['student_id'].count().reset_index(name='count')
-        currency_table = currency_table.sort_values(by='count', ascending=False)
         # st.write("💰 Currency Distribution")
-        # st.write(currency_table.set_index('currency').T)
+        # st.write(breakdown('currency'))
 
         # Plan distribution for retention
-        currency_table = filtered_data.groupby('plan')['student_id'].count().reset_index(name='count')
-        currency_table = currency_table.sort_values(by='count', ascending=False)
         st.write("🗂️ Plan Distribution")
-        st.write(currency_table.set_index('plan').T)
-
-        renewed_pivot = filtered_data.pivot_table(
-            values='student_id',
-            index='cohort_month',
-            columns='months_count_from_subscription',
-            aggfunc='count'
-        )
+        st.write(breakdown('plan'))
+
+        renewed_pivot = pivot('renewed')
         st.subheader("🔁 Retention Achieved")
         st.write(renewed_pivot)
     
-        renewed_revenue_pivot = filtered_data.pivot_table(
-            values='paid_amount',
-            index='cohort_month',
-            columns='months_count_from_subscription',
-            aggfunc='sum'
-        )
+        renewed_revenue_pivot = pivot('renewed_revenue')
         st.subheader("💰 Renewed Revenue")
         st.write(renewed_revenue_pivot)
 
 else:
     # For churned data, same logic applies
-    if cohort_month == 'All Cohort Months':
-        filtered_data = churned_df
-    else:
-        filtered_data = churned_df[churned_df['cohort_month'] == cohort_month]
-
-    if months_count == 'All Months in Cohort':
-        filtered_data = filtered_data
-    else:
-        filtered_data = filtered_data[filtered_data['months_count_from_subscription'] == months_count]
-
-    # filtered_data = filtered_data[['student_id', 'subscribed_at', 'expired_at', 'currency']]
-
     st.subheader(f"📊 Churned for Cohort {cohort_month} - Months Count {months_count}")
-    if filtered_data.empty:
+    if rows_count == 0:
         st.info("No data available for this filter combination.")
     else:
-        # st.write(filtered_data[['student_id', 'subscribed_at', 'expired_at', 'currency']])
-
         # Country distribution for churn
-        country_table = students_df[students_df['id'].isin(filtered_data['student_id'])] \
-            .groupby('country')['id'].count().reset_index(name='count')
-        country_table = country_table.sort_values(by='count', ascending=False)
         st.write("🎓 Country Distribution")
-        st.write(country_table.set_index('country').T)
+        st.write(breakdown('country'))
 
         # Currency distribution for churn
-        currency_table = filtered_data.groupby('currency')['student_id'].count().reset_index(name='count')
-        currency_table = currency_table.sort_values(by='count', ascending=False)
         # st.write("💰 Currency Distribution")
-        # st.write(currency_table.set_index('currency').T)
+        # st.write(breakdown('currency'))
 
         # Grades distribution for churn
-        country_table = students_df[students_df['id'].isin(filtered_data['student_id'])] \
-            .groupby('last_or_current_grade_and_module')['id'].count().reset_index(name='count')
-        country_table = country_table.sort_values(by='count', ascending=False)
         st.write("🎓 Grade Distribution")
-        st.write(country_table.set_index('last_or_current_grade_and_module').T)
+        st.write(breakdown('last_or_current_grade_and_module'))
 
         # Instructor distribution for churn
-        country_table = students_df[students_df['id'].isin(filtered_data['student_id'])] \
-            .groupby('last_or_current_tutor')['id'].count().reset_index(name='count')
-        country_table = country_table.sort_values(by='count', ascending=False)
         st.write("👨‍🏫 Instructor Breakdown")
-        st.write(country_table.set_index('last_or_current_tutor').T)
+        st.write(breakdown('last_or_current_tutor'))
 
         # Lost reason distribution for churn
-        country_table = students_df[students_df['id'].isin(filtered_data['student_id'])] \
-            .groupby('lost_reason')['id'].count().reset_index(name='count')
-        country_table = country_table.sort_values(by='count', ascending=False)
         st.write("🔍 Lost Reason Breakdown")
-        st.write(country_table.set_index('lost_reason').T)
+        st.write(breakdown('lost_reason'))
 
         # Pivot table for churned subscriptions
-        churned_pivot = filtered_data.pivot_table(
-            values='student_id',
-            index='cohort_month',
-            columns='months_count_from_subscription',
-            aggfunc='count'
-        )
+        churned_pivot = pivot('churned')
         st.subheader("📉 Churned Subscriptions")
         st.write(churned_pivot)
 
         # Pivot table for churned AOV projection
-        churned_aov_projection_pivot = (churned_pivot * aov).applymap(lambda x: int(x) if pd.notna(x) else None)
+        churned_aov_projection_pivot = (churned_pivot * aov).astype('Int64')
         st.subheader("💸 Churned ARPU projection")
         st.write(churned_aov_projection_pivot)
+
+render_debug_panel()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+
+# Tables materialized by `python -m utils.precompute`, read by the pages instead of computing them live.
+# Every run writes a version directory of parquet files and its manifest, then points ARTIFACTS_DIR/manifest.json at it.
+ARTIFACTS_DIR = os.environ.get('DASHBOARD_ARTIFACTS', 'artifacts')
+MANIFEST_NAME = 'manifest.json'
+ARTIFACTS_FORMAT = 1
+
+
+def artifact_inputs(*inputs):
+    # Data version, as-of date, ... of an artifact, compared as their JSON text
+    return json.dumps(inputs, default=str)
+
+def _json_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _write_frame(frame, path):
+    # Labels are kept in the manifest, parquet only gets positional column names
+    index_names = list(frame.index.names)
+    columns = frame.columns
+    frame = frame.set_axis([f'__column_{position}__' for position in range(len(columns))], axis=1)
+    frame = frame.rename_axis([f'__index_{position}__' for position in range(len(index_names))], axis=0)
+    frame.reset_index().to_parquet(path, index=False)
+
+    return {
+        'index_names': index_names,
+        'columns': [_json_value(label) for label in columns],
+        'columns_dtype': str(columns.dtype),
+        'columns_name': columns.name,
+        'rows': len(frame),
+    }
+
+def _read_frame(path, entry):
+    frame = pd.read_parquet(path)
+    index_columns = [f'__index_{position}__' for position in range(len(entry['index_names']))]
+    frame = frame.set_index(index_columns)
+    frame.index.names = entry['index_names']
+    frame.columns = pd.Index(entry['columns'], dtype=entry['columns_dtype'], name=entry['columns_name'])
+
+    return frame
+
+def _write_value(value, directory, name, tables):
+    # Nested dicts are flattened to "a/b/c" names, every table gets its own parquet file
+    if isinstance(value, dict):
+        tables[name] = {'kind': 'dict', 'keys': list(value)}
+        for key, item in value.items():
+            _write_value(item, directory, f'{name}/{key}', tables)
+        return
+
+    file_name = f'{len(tables):04d}.parquet'
+    path = os.path.join(directory, file_name)
+    if isinstance(value, pd.DataFrame):
+        tables[name] = {'kind': 'frame', 'file': file_name, **_write_frame(value, path)}
+    elif isinstance(value, pd.Series):
+        tables[name] = {'kind': 'series', 'file': file_name, 'name': _json_value(value.name), **_write_frame(value.to_frame('values'), path)}
+    elif isinstance(value, list):
+        tables[name] = {'kind': 'list', 'file': file_name, **_write_frame(pd.DataFrame({'values': pd.Series(value, dtype=None if value else 'object')}), path)}
+    else:
+        tables[name] = {'kind': 'scalar', 'value': _json_value(value)}
+
+def _read_value(directory, name, tables):
+    entry = tables[name]
+    if entry['kind'] == 'dict':
+        return {key: _read_value(directory, f'{name}/{key}', tables) for key in entry['keys']}
+    if entry['kind'] == 'scalar':
+        return entry['value']
+
+    frame = _read_frame(os.path.join(directory, entry['file']), entry)
+    if entry['kind'] == 'series':
+        return frame['values'].rename(entry['name'])
+    if entry['kind'] == 'list':
+        return frame['values'].tolist()
+
+    return frame
+
+
+def write_artifacts(artifacts, artifacts_dir=ARTIFACTS_DIR, keep=3):
+    # artifacts: name -> (inputs from artifact_inputs, frame / series / list / scalar / nested dict of them)
+    created_at = datetime.now(timezone.utc)
+    digest = hashlib.sha1(json.dumps({name: inputs for name, (inputs, _) in artifacts.items()}, sort_keys=True).encode()).hexdigest()[:12]
+    version = f'{created_at:%Y%m%dT%H%M%S}-{digest}'
+    version_dir = os.path.join(artifacts_dir, version)
+    os.makedirs(version_dir)
+
+    manifest = {'format': ARTIFACTS_FORMAT, 'version': version, 'created_at': created_at.isoformat(), 'artifacts': {}}
+    for name, (inputs, value) in artifacts.items():
+        artifact_dir = os.path.join(version_dir, name)
+        os.makedirs(artifact_dir)
+        tables = {}
+        _write_value(value, artifact_dir, name, tables)
+        manifest['artifacts'][name] = {'inputs': inputs, 'tables': tables}
+
+    with open(os.path.join(version_dir, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    # Readers switch to the new version at once, then older versions beyond `keep` are removed
+    current_path = os.path.join(artifacts_dir, MANIFEST_NAME)
+    with open(current_path + '.tmp', 'w') as manifest_file:
+        json.dump({'format': ARTIFACTS_FORMAT, 'version': version}, manifest_file)
+    os.replace(current_path + '.tmp', current_path)
+
+    versions = sorted(entry for entry in os.listdir(artifacts_dir) if os.path.isfile(os.path.join(artifacts_dir, entry, MANIFEST_NAME)))
+    for old_version in versions[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(artifacts_dir, old_version), ignore_errors=True)
+
+    return manifest
+
+
+def _read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def current_version(artifacts_dir=ARTIFACTS_DIR):
+    pointer = _read_json(os.path.join(artifacts_dir, MANIFEST_NAME))
+    if pointer is None or pointer.get('format') != ARTIFACTS_FORMAT:
+        return None
+
+    return pointer['version']
+
+@st.cache_resource(max_entries=4)
+def read_manifest(artifacts_dir, version):
+    return _read_json(os.path.join(artifacts_dir, version, MANIFEST_NAME))
+
+# Artifacts are shared between sessions without copying, callers must treat them as read-only
+@st.cache_resource(max_entries=16)
+def read_artifact(artifacts_dir, version, name):
+    tables = read_manifest(artifacts_dir, version)['artifacts'][name]['tables']
+
+    return _read_value(os.path.join(artifacts_dir, version, name), name, tables)
+
+def load_artifact(name, inputs, artifacts_dir=ARTIFACTS_DIR):
+    # None when there is no precomputed artifact for these inputs, callers then compute the value live
+    version = current_version(artifacts_dir)
+    if version is None:
+        return None
+    manifest = read_manifest(artifacts_dir, version)
+    if manifest is None or manifest['artifacts'].get(name, {}).get('inputs') != inputs:
+        return None
+
+    return read_artifact(artifacts_dir, version, name)
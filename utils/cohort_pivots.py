@@ -0,0 +1,142 @@
+from utils.instrumentation import instrument, profile_stage
+from utils.student_dimensions import student_positions, gather_dimension
+from utils.task_pool import run_jobs
+
+
+def cohort_pivot(frame, columns='months_count_from_subscription', values='student_id', aggfunc='count'):
+    return frame.pivot_table(
+        values=values,
+        index='cohort_month',
+        columns=columns,
+        aggfunc=aggfunc
+    )
+
+def attribute_pivot(frame, column):
+    # Counts per cohort month and attribute value, largest attribute totals first
+    pivot = frame.pivot_table(
+        values='student_id',
+        index='cohort_month',
+        columns=column,
+        aggfunc='count',
+        fill_value=0,
+        observed=True
+    )
+
+    return order_attribute_columns(pivot)
+
+def order_attribute_columns(pivot):
+    pivot = pivot[pivot.sum().sort_values(ascending=False).index]
+
+    # Categorical student attributes are turned back into plain labels for display
+    pivot.columns = pivot.columns.astype(object)
+
+    return pivot
+
+def cohort_student_counts(frame):
+    return frame.groupby('cohort_month')['student_id'].nunique()
+
+@instrument
+def attach_student_attributes(total_subs_df, student_dimensions, columns=('country', 'last_or_current_grade_and_module')):
+    # Student metadata by position, currency is already in the subscriptions
+    positions = student_positions(student_dimensions, total_subs_df['student_id'])
+
+    return total_subs_df.assign(**{column: gather_dimension(student_dimensions, column, positions) for column in columns})
+
+
+# Renewals Forecast pivots: name -> (function, cohort frame, keyword arguments)
+FORECAST_PIVOTS = {
+    'total_subs': (cohort_pivot, 'total_subs', {}),
+    'renewed': (cohort_pivot, 'renewed', {}),
+    'renewed_revenue': (cohort_pivot, 'renewed', {'values': 'paid_amount', 'aggfunc': 'sum'}),
+    'churned': (cohort_pivot, 'churned', {}),
+    'country': (attribute_pivot, 'subs_with_info', {'column': 'country'}),
+    'grade_module': (attribute_pivot, 'subs_with_info', {'column': 'last_or_current_grade_and_module'}),
+    'currency': (attribute_pivot, 'subs_with_info', {'column': 'currency'}),
+    'renewed_subscription_number': (cohort_pivot, 'renewed', {'columns': 'subscription_count'}),
+    'churned_subscription_number': (cohort_pivot, 'churned', {'columns': 'subscription_count'}),
+    'cohort_students': (cohort_student_counts, 'total_subs', {}),
+}
+
+def select_forecast_pivots(names=None):
+    # Subset of the registry in the given order, every pivot when names is None
+    if names is None:
+        return FORECAST_PIVOTS
+    unknown = [name for name in names if name not in FORECAST_PIVOTS]
+    if unknown:
+        raise ValueError(f"Unknown forecast pivots {', '.join(map(repr, unknown))}, expected any of {', '.join(FORECAST_PIVOTS)}")
+
+    return {name: FORECAST_PIVOTS[name] for name in names}
+
+def pivot_job(name, function, frame, kwargs):
+    def job():
+        with profile_stage(f'pivot.{name}', len(frame)) as record:
+            pivot = function(frame, **kwargs)
+            record['rows_out'] = len(pivot)
+
+        return pivot
+
+    return job
+
+@instrument
+def build_forecast_pivots(total_subs_df, renewed_df, churned_df, student_dimensions, pivots=FORECAST_PIVOTS, workers=None):
+    cohort_frames = {
+        'total_subs': total_subs_df,
+        'renewed': renewed_df,
+        'churned': churned_df,
+        'subs_with_info': attach_student_attributes(total_subs_df, student_dimensions),
+    }
+
+    # Every pivot only reads its prepared frame, so they run side by side
+    jobs = {name: pivot_job(name, function, cohort_frames[frame], kwargs) for name, (function, frame, kwargs) in pivots.items()}
+
+    return run_jobs(jobs, workers)
+
+# Pivots whose cells are sums over rows, a later cut-off only adds the rows that entered since the previous one
+ADDITIVE_PIVOT_FUNCTIONS = (cohort_pivot, attribute_pivot)
+
+def merge_pivot(function, previous, delta):
+    if delta.empty:
+        return previous
+    pivot = previous.add(delta, fill_value=0).sort_index().sort_index(axis=1)
+
+    if function is attribute_pivot:
+        return order_attribute_columns(pivot.fillna(0).astype('int64'))
+    if all(previous.dtypes == 'int64') and all(delta.dtypes == 'int64') and pivot.notna().all().all():
+        pivot = pivot.astype('int64')
+
+    return pivot
+
+def merge_job(name, function, previous, frame, kwargs):
+    def job():
+        with profile_stage(f'pivot.{name}.delta', len(frame)) as record:
+            pivot = merge_pivot(function, previous, function(frame, **kwargs))
+            record['rows_out'] = len(pivot)
+
+        return pivot
+
+    return job
+
+@instrument
+def update_forecast_pivots(previous_pivots, cohort_frames, delta_frames, student_dimensions, pivots=FORECAST_PIVOTS, workers=None):
+    # previous_pivots were built on an earlier cut-off, delta_frames hold the cohort rows between the two cut-offs.
+    # Additive pivots only aggregate the delta rows, the others are rebuilt on the full cohort_frames.
+    total_subs_df, renewed_df, churned_df = cohort_frames
+    delta_total_subs_df, delta_renewed_df, delta_churned_df = delta_frames
+    full_frames = {'total_subs': total_subs_df, 'renewed': renewed_df, 'churned': churned_df}
+    delta_frames = {
+        'total_subs': delta_total_subs_df,
+        'renewed': delta_renewed_df,
+        'churned': delta_churned_df,
+        'subs_with_info': attach_student_attributes(delta_total_subs_df, student_dimensions),
+    }
+
+    jobs = {}
+    for name, (function, frame, kwargs) in pivots.items():
+        if function in ADDITIVE_PIVOT_FUNCTIONS and name in previous_pivots:
+            jobs[name] = merge_job(name, function, previous_pivots[name], delta_frames[frame], kwargs)
+        else:
+            if frame not in full_frames:
+                full_frames[frame] = attach_student_attributes(total_subs_df, student_dimensions)
+            jobs[name] = pivot_job(name, function, full_frames[frame], kwargs)
+
+    return run_jobs(jobs, workers)
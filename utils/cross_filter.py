@@ -0,0 +1,144 @@
+from utils.data_utils import pd, np, prepare_cohort_base, cut_cohort_frames, get_data_version, get_current_day
+from utils.filter_cube import ALL, CELL_KEYS, STUDENT_BREAKDOWNS, SUBSCRIPTION_BREAKDOWNS, SUBSCRIPTION_TYPES, breakdown_table, pivot_table_result
+from utils.instrumentation import instrument
+from utils.snapshots import daily_snapshot
+from utils.student_dimensions import prepare_student_dimensions, student_positions
+
+
+# Sidebar multiselects of the Filter Viewer, any combination of values is answered by intersecting row bitmaps
+FILTER_COLUMNS = ['country', 'plan', 'currency', 'last_or_current_tutor', 'last_or_current_grade_and_module']
+
+
+def _frame_index(frame, spec, student_dimensions):
+    # Integer codes of every row: student attributes through the student's position, subscription columns and
+    # the pivot cell from the frame
+    positions = student_positions(student_dimensions, frame['student_id'])
+    index = {'rows': len(frame), 'positions': positions, 'codes': {}, 'labels': {}, 'bitmaps': {}}
+
+    for column in STUDENT_BREAKDOWNS:
+        index['codes'][column] = np.where(positions >= 0, student_dimensions['codes'][column][positions], -1)
+        index['labels'][column] = pd.Index(student_dimensions['categories'][column], dtype=object)
+    for column in SUBSCRIPTION_BREAKDOWNS + CELL_KEYS:
+        codes, labels = pd.factorize(frame[column], sort=True)
+        index['codes'][column] = codes
+        index['labels'][column] = pd.Index(labels, name=column) if column in CELL_KEYS else pd.Index(labels, dtype=object)
+
+    n_months = len(index['labels']['months_count_from_subscription'])
+    cohort_codes, months_codes = index['codes']['cohort_month'], index['codes']['months_count_from_subscription']
+    # Rows without a cell (missing month) stay out of the pivots, like in pivot_table
+    index['cells'] = np.where((cohort_codes >= 0) & (months_codes >= 0), cohort_codes * n_months + months_codes, -1)
+    index['values'] = {value: frame[value].to_numpy(dtype='float64') for value, _ in spec['pivots'].values() if value != 'student_id'}
+
+    return index
+
+@instrument
+def build_cross_filter(total_subs_df, renewed_df, churned_df, student_dimensions):
+    cohort_frames = {'renewed': renewed_df, 'churned': churned_df}
+    cross_filter = {
+        subscription_type: _frame_index(cohort_frames[spec['frame']], spec, student_dimensions)
+        for subscription_type, spec in SUBSCRIPTION_TYPES.items()
+    }
+    cross_filter['students'] = student_dimensions['index']
+    cross_filter['student_codes'] = {column: student_dimensions['codes'][column] for column in STUDENT_BREAKDOWNS}
+    cross_filter['options'] = {
+        column: sorted(set().union(*(cross_filter[subscription_type]['labels'][column] for subscription_type in SUBSCRIPTION_TYPES)))
+        for column in FILTER_COLUMNS
+    }
+
+    return cross_filter
+
+def prepare_cross_filter(data_version, as_of):
+    cohort_base = prepare_cohort_base(data_version)
+    student_dimensions = prepare_student_dimensions(data_version)
+
+    def build(as_of):
+        return build_cross_filter(*cut_cohort_frames(cohort_base, as_of), student_dimensions)
+
+    return daily_snapshot('cross_filter', data_version, as_of, build)
+
+@instrument
+def load_cross_filter(as_of=None):
+    return prepare_cross_filter(get_data_version(), as_of or get_current_day())
+
+
+def value_bitmap(frame_index, column, value):
+    # Packed bitmap of the rows holding value, built the first time the value is selected and kept in the index.
+    # Concurrent first selections may both build it, the results are identical.
+    key = (column, value)
+    if key not in frame_index['bitmaps']:
+        code = frame_index['labels'][column].get_indexer([value])[0]
+        frame_index['bitmaps'][key] = np.packbits(frame_index['codes'][column] == code) if code >= 0 else np.zeros((frame_index['rows'] + 7) // 8, dtype='uint8')
+
+    return frame_index['bitmaps'][key]
+
+@instrument
+def select_rows(cross_filter, subscription_type, filters, cohort_month=ALL, months_count=ALL):
+    # filters: column -> selected values. Values of a column are OR-ed, columns are AND-ed, empty selections are ignored.
+    # The selection holds the positions of the matching rows.
+    frame_index = cross_filter[subscription_type]
+    conditions = {column: values for column, values in filters.items() if len(values)}
+    if cohort_month != ALL:
+        conditions['cohort_month'] = [cohort_month]
+    if months_count != ALL:
+        conditions['months_count_from_subscription'] = [months_count]
+
+    bitmap = None
+    for column, values in conditions.items():
+        column_bitmap = np.bitwise_or.reduce([value_bitmap(frame_index, column, value) for value in values])
+        bitmap = column_bitmap if bitmap is None else bitmap & column_bitmap
+
+    rows = np.arange(frame_index['rows']) if bitmap is None else np.flatnonzero(np.unpackbits(bitmap, count=frame_index['rows']))
+
+    return {'cross_filter': cross_filter, 'subscription_type': subscription_type, 'rows': rows}
+
+def selected_students(selection):
+    # Students of the selected rows as a mask over the student positions, computed once per selection
+    if 'students' not in selection:
+        positions = selection['cross_filter'][selection['subscription_type']]['positions'][selection['rows']]
+        students = np.zeros(len(selection['cross_filter']['students']), dtype=bool)
+        students[positions[positions >= 0]] = True
+        selection['students'] = students
+
+    return selection['students']
+
+
+def selection_rows_count(selection):
+    return len(selection['rows'])
+
+@instrument
+def selection_breakdown(selection, column):
+    # Same table as lookup_breakdown: distinct students per student attribute value, rows per subscription column value
+    frame_index = selection['cross_filter'][selection['subscription_type']]
+    labels = frame_index['labels'][column]
+    if column in STUDENT_BREAKDOWNS:
+        codes = selection['cross_filter']['student_codes'][column][selected_students(selection)]
+    else:
+        codes = frame_index['codes'][column].take(selection['rows'])
+
+    # Missing values (-1) land in the first bin and are dropped
+    counts = pd.Series(np.bincount(codes.astype(np.intp) + 1, minlength=len(labels) + 1)[1:], index=labels)
+
+    return breakdown_table(counts[counts > 0], column)
+
+@instrument
+def selection_pivot(selection, pivot):
+    # Same table as lookup_pivot, aggregated with bincount over the pivot cell of the selected rows
+    subscription_type = selection['subscription_type']
+    frame_index = selection['cross_filter'][subscription_type]
+    value, aggfunc = SUBSCRIPTION_TYPES[subscription_type]['pivots'][pivot]
+    cohort_months = frame_index['labels']['cohort_month']
+    months_counts = frame_index['labels']['months_count_from_subscription']
+
+    # Rows without a cell land in the first bin and are dropped
+    cells = frame_index['cells'].take(selection['rows']) + 1
+    size = len(cohort_months) * len(months_counts) + 1
+    shape = (len(cohort_months), len(months_counts))
+    counts = np.bincount(cells, minlength=size)[1:].reshape(shape)
+    if aggfunc == 'sum':
+        totals = np.bincount(cells, weights=frame_index['values'][value].take(selection['rows']), minlength=size)[1:].reshape(shape)
+    else:
+        totals = counts
+
+    table = pd.DataFrame(np.where(counts > 0, totals, np.nan), index=cohort_months, columns=months_counts)
+
+    return pivot_table_result(table, subscription_type, pivot)
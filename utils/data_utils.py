@@ -1,200 +1,197 @@
 import pandas as pd
-from pandas.tseries.offsets import DateOffset
+import numpy as np
 import streamlit as st
 import altair as alt
-import ast
 from datetime import datetime
 import pytz
+import os
+import threading
+from utils.instrumentation import instrument
+from utils.schema import STUDENTS_SCHEMA, SUBSCRIPTIONS_SCHEMA, compact_frame
+from utils.segments import sort_segments, segment_rank, segment_broadcast, segment_shift
 
 
 aov = 5900
 cairo = pytz.timezone("Africa/Cairo")
-current_day = datetime.now(cairo).replace(hour=0, minute=0, second=0, microsecond=0)
 
-@st.cache_data
-def load_data():
-    students_df = pd.read_parquet('students_sample.parquet')
-    subscriptions_df = pd.read_parquet('subscriptions_sample.parquet')
-
-    return students_df, subscriptions_df
-
-def get_subscriptions_by_currency(subscriptions_df, currency):
-    return subscriptions_df[subscriptions_df['currency'] == currency]
-
-
-def format_currency(value, currency='egp'):
-    symbol_map = {
-        'egp': 'EGP', 'USD': '$', 'EUR': '€', 'AED': 'AED',
-    }
-    symbol = symbol_map.get(currency, currency)
-    return f"{symbol} {int(value):,}"
+def as_of_from_date(day):
+    # Cohort cut-off at the start of a calendar day in Cairo
+    return cairo.localize(datetime.combine(day, datetime.min.time()))
+
+def get_current_day():
+    # Evaluated on every call, a long-running server moves to the new cut-off when the day rolls over
+    return as_of_from_date(datetime.now(cairo).date())
+
+STUDENTS_PATH = 'students_sample.parquet'
+SUBSCRIPTIONS_PATH = 'subscriptions_sample.parquet'
+# Position of each file in a data version
+STUDENTS_FILE, SUBSCRIPTIONS_FILE = 0, 1
+
+def file_data_version(paths=(STUDENTS_PATH, SUBSCRIPTIONS_PATH)):
+    # Identity of the parquet files on disk, changes whenever one of them is replaced
+    data_version = []
+    for path in paths:
+        stat = os.stat(path)
+        data_version.append((path, stat.st_mtime_ns, stat.st_size))
+
+    return tuple(data_version)
+
+def check_data_file(data_version, position):
+    # Path of one file of a data version, still unchanged since the version was taken. A file replaced (or still
+    # being copied) meanwhile raises instead of being read under the old version. Checked before and after reading
+    file_version = data_version[position]
+    if file_data_version(file_version[:1])[0] != file_version:
+        raise RuntimeError(f"{file_version[0]} changed since data version {data_version} was taken, it can no longer be read")
+
+    return file_version[0]
+
+# Data version the pages read. The background refresher (utils/refresher.py) serves a new one only once its tables
+# are prepared, without a refresher (CLIs, benchmarks) the files on disk are read directly
+_served = {'data_version': None}
+_pinned = threading.local()
+
+def serve_data_version(data_version):
+    # A single assignment, every later page run switches to the new files at once
+    _served['data_version'] = data_version
+
+def served_data_version():
+    return _served['data_version']
+
+def pin_data_version():
+    # Every table of a script run comes from the same data version, even when a new one is served meanwhile
+    _pinned.data_version = served_data_version()
+
+def get_data_version():
+    return getattr(_pinned, 'data_version', None) or served_data_version() or file_data_version()
+
+# Columns needed to derive the cohort frames shared by the analysis pages
+COHORT_SUBSCRIPTION_COLUMNS = ('student_id', 'created_at', 'expired_at', 'currency', 'plan', 'paid_amount')
+
+# Only the requested columns are read from the parquet files of the data version, None reads everything.
+# Frames are compacted to the dtypes of utils/schema.py, the cache pickles and copies them on every hit
+@st.cache_data(max_entries=16)
+def read_students(data_version, columns=None):
+    students_df = pd.read_parquet(check_data_file(data_version, STUDENTS_FILE), columns=list(columns) if columns is not None else None)
+    check_data_file(data_version, STUDENTS_FILE)
+
+    return prepare_students_frame(students_df)
+
+@st.cache_data(max_entries=16)
+def read_subscriptions(data_version, columns=None):
+    subscriptions_df = pd.read_parquet(check_data_file(data_version, SUBSCRIPTIONS_FILE), columns=list(columns) if columns is not None else None)
+    check_data_file(data_version, SUBSCRIPTIONS_FILE)
+
+    return prepare_subscriptions_frame(subscriptions_df)
+
+# Applied to whole tables and to the batches of the streaming aggregations alike
+def prepare_students_frame(students_df):
+    return compact_frame(students_df, STUDENTS_SCHEMA)
+
+def prepare_subscriptions_frame(subscriptions_df):
+    return compact_frame(subscriptions_df, SUBSCRIPTIONS_SCHEMA)
+
+@instrument
+def build_cohort_base(subscriptions_df):
+    # Everything that does not depend on the cut-off: numbering, first subscription, previous and last expiry.
+    # Each frame comes with the timestamp compared against the cut-off.
+    # One sort by student_id and expired_at (ties in created_at order), students become contiguous segments
+    segments = sort_segments(subscriptions_df['student_id'], subscriptions_df['expired_at'], subscriptions_df['created_at'])
+    subscriptions_df = subscriptions_df.take(segments.order)
+
+    # Subscription number in created_at order (starts from 0) and the first subscription of every student
+    subscription_count = segment_rank(segments, subscriptions_df['created_at'])
+    subscriptions_df['subscription_count'] = subscription_count
+    subscriptions_df['subscribed_at'] = segment_broadcast(segments, subscriptions_df['created_at'], np.flatnonzero(subscription_count == 0))
+
+    # Prepare total subscriptions
+    total_subs_df = subscriptions_df.copy()
+    total_subs_df['cohort_month'] = total_subs_df['expired_at'].dt.to_period('M')
+    total_subs_df['months_count_from_subscription'] = (((total_subs_df['expired_at'] - total_subs_df['subscribed_at']).dt.days) / 30).round()
+
+    # Prepare renewed subscriptions
+    renewed_df = subscriptions_df.copy()
+    renewed_at = segment_shift(segments, renewed_df['expired_at'])
+    renewed_df['cohort_month'] = renewed_at.dt.to_period('M')
+    renewed_df['months_count_from_subscription'] = (((renewed_at - renewed_df['subscribed_at']).dt.days) / 30).round()
+
+    # Prepare churned subscriptions, the last row of every student
+    churned_df = subscriptions_df.take(segments.ends).reset_index(drop=True)
+    churned_df.insert(0, 'student_id', churned_df.pop('student_id'))
+    churned_df['cohort_month'] = churned_df['expired_at'].dt.to_period('M')
+    churned_df['months_count_from_subscription'] = (((churned_df['expired_at'] - churned_df['subscribed_at']).dt.days) / 30).round()
+
+    return (
+        (total_subs_df, total_subs_df['expired_at']),
+        (renewed_df, renewed_at),
+        (churned_df, churned_df['expired_at']),
+    )
 
+def cut_cohort_frames(cohort_base, as_of, since=None):
+    # Rows that entered their cohort before as_of, or only those that entered in [since, as_of)
+    frames = []
+    for frame, cohort_at in cohort_base:
+        in_cohort = cohort_at < as_of
+        if since is not None:
+            in_cohort &= cohort_at >= since
+        frames.append(frame[in_cohort.to_numpy()])
 
-def compute_egp_financial_metrics (subscriptions_df):
-    egp_subs = get_subscriptions_by_currency(subscriptions_df, 'egp')
+    return tuple(frames)
 
-    return {
-        'total_revenue': egp_subs['paid_amount'].sum() + egp_subs['remaining_amount'].sum(),
-        'net_revenue': egp_subs['paid_amount'].sum() - egp_subs['refund_amount'].sum(),
-        'remaining_amount': egp_subs['remaining_amount'].sum(),
-        'refunded_amount': egp_subs['refund_amount'].sum()
-    }
+@instrument
+def build_cohort_frames(subscriptions_df, as_of):
+    return cut_cohort_frames(build_cohort_base(subscriptions_df), as_of)
 
-def compute_total_students_count(students_df):
-    total_students_count = students_df['id'].shape[0]
+# Cut-off independent part, computed once per data version. Shared without copying, callers must treat it as read-only
+@st.cache_resource(max_entries=2)
+def prepare_cohort_base(data_version):
+    subscriptions_df = read_subscriptions(data_version, COHORT_SUBSCRIPTION_COLUMNS)
 
-    return total_students_count
+    return build_cohort_base(subscriptions_df)
 
-def compute_free_students_count(students_df):
-    free_students = students_df[students_df['status'] == 'free'].shape[0]
+def select_as_of():
+    # Sidebar cut-off date, today by default. Earlier days show the cohort tables as they were then
+    today = get_current_day().date()
+    day = st.sidebar.date_input("As of", value=today, max_value=today)
 
-    return free_students
+    return as_of_from_date(day)
 
-def compute_non_churned_students_count(students_df):
-    return{
-        'active': students_df[students_df['status'] == 'active'].shape[0],
-        'inactive': students_df[students_df['status'] == 'pending_schedule'].shape[0],
-        'pending': students_df[students_df['status'] == 'pending'].shape[0],
-    }
 
-def compute_churned_students_count(students_df):
-    return{
-        'expired': students_df[students_df['status'] == 'expired'].shape[0],
-        'canceled': students_df[students_df['status'] == 'canceled'].shape[0],
+def currency_symbol(currency):
+    symbol_map = {
+        'egp': 'EGP', 'usd': '$', 'eur': '€', 'aed': 'AED',
     }
+    return symbol_map.get(currency.lower(), currency.upper())
 
-def compute_churn_rate(students_df):
-    non_churned_students_status = compute_non_churned_students_count(students_df)
-    churned_students_status = compute_churned_students_count(students_df)
-
-    total_paid_students = non_churned_students_status['active'] + non_churned_students_status['inactive'] + non_churned_students_status['pending'] + churned_students_status['expired'] + churned_students_status['canceled']
-    total_churned_students = churned_students_status['expired'] + churned_students_status['canceled']
-    churn_rate = total_churned_students / total_paid_students * 100
-
-    return churn_rate
-
-def compute_arpu_for_egp(subscriptions_df):
-    egp_subs = get_subscriptions_by_currency(subscriptions_df, 'egp')
-
-    total_revenue = egp_subs['paid_amount'].sum() + egp_subs['remaining_amount'].sum()
-    total_users = egp_subs['student_id'].nunique()
-    arpu = total_revenue / total_users
-
-    return arpu
-
-def plot_yearly_revenue_trends(currency_subs: pd.DataFrame, currency):
-    # Calculate yearly metrics
-    yearly_total_revenue = currency_subs.groupby('created_at_year')[['paid_amount', 'remaining_amount']].sum().sum(axis=1)
-    yearly_net_revenue = (currency_subs.groupby('created_at_year')[['paid_amount', 'refund_amount']].sum().eval('paid_amount - refund_amount')).reindex(yearly_total_revenue.index).fillna(0)
-    yearly_refund_amount = (currency_subs.groupby('refund_at_year')['refund_amount'].sum()).reindex(yearly_total_revenue.index).fillna(0)
-
-    # Create DataFrame for metrics
-    yearly_metrics = pd.DataFrame({
-        'Year': yearly_total_revenue.index,
-        'Total Revenue': yearly_total_revenue.values,
-        'Net Revenue': yearly_net_revenue.values,
-        'Refund Amount': yearly_refund_amount.values
-    })
-
-    # Melt the data to long format for Altair charting
-    melted_data = yearly_metrics.melt(
-        id_vars=['Year'],
-        value_vars=['Total Revenue', 'Net Revenue', 'Refund Amount'],
-        var_name='Category',
-        value_name='Amount'
-    )
-
-    # Format the Amount for tooltips
-    melted_data['Formatted Amount'] = melted_data['Amount'].apply(lambda x: f"{currency} {x:,.0f}")
-
-    # Display subheader and intro
-    st.subheader(f"📈 {currency}: Yearly Revenue Trends")
-    st.markdown(f"""
-    This chart shows the yearly trends for **{currency} transactions only**:
-    - 💰 Total Revenue
-    - 📊 Net Revenue
-    - ↪️ Refund Amount
-    """)
-
-    # Define custom order for categories
-    category_order = ['Total Revenue', 'Net Revenue', 'Refund Amount']
-
-    # Create interactive Altair chart
-    selection = alt.selection_point(fields=['Category'], bind='legend', empty='all')
-
-    line_chart = alt.Chart(melted_data).mark_line(point=True).encode(
-        x=alt.X('Year:O', title="Year"),
-        y=alt.Y('Amount:Q', title=f"Amount ({currency})"),
-        color=alt.Color('Category:N', title="Category", sort=category_order,
-                        legend=alt.Legend(labelFontSize=12, labelFont='Arial', labelLimit=200, titlePadding=15)),
-        tooltip=['Year', 'Category', 'Formatted Amount'],
-        opacity=alt.condition(selection, alt.value(1), alt.value(0.3))
-    ).add_params(selection)
-
-    # Show the chart
-    st.altair_chart(line_chart, use_container_width=True)
-
-def plot_yearly_user_trends(students_df: pd.DataFrame, subscriptions_df: pd.DataFrame):
-    activated_subs = subscriptions_df[
-    subscriptions_df['expired_at'] < subscriptions_df['activated_at'] + DateOffset(months=18)
-    ]
-    
-    # Explode to one row per active year per student
-    activated_subs['active_years'] = activated_subs['active_years'].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-    exploded = activated_subs[['student_id', 'active_years']].explode('active_years').drop_duplicates()
-
-    # Calculate yearly metrics
-    yearly_registered_students = students_df.groupby('created_at_year')['id'].count()
-    yearly_active_students = exploded.groupby('active_years')['student_id'].nunique()
-    yearly_registered_free_students = students_df[students_df['signed_up_free'] == 1].groupby('created_at_year')['id'].count()
-
-    # Build DataFrame
-    yearly_metrics = pd.DataFrame({
-        'Year': yearly_registered_students.index,
-        'Total Registered Students': yearly_registered_students,
-        'Active Students': yearly_active_students,
-        'Free Registered Students': yearly_registered_free_students
-    }).fillna(0)
-
-    # Melt for visualization
-    melted_data = yearly_metrics.reset_index().melt(
-        id_vars=['Year'],
-        value_vars=['Total Registered Students', 'Active Students', 'Free Registered Students'],
-        var_name='Category',
-        value_name='Count'
-    )
-
-    melted_data['Formatted Count'] = melted_data['Count'].apply(lambda x: f"{x:,.0f}")
-
-    # Subheader and explanation
-    st.subheader("📊 User Trends Over Time")
-    st.markdown("""
-    This chart shows the yearly trends for users:
-    - 📈 Total Registered Users
-    - 🔥 Active Users
-    - 🚀 Free Registered Users
-    """)
-
-    # Custom order for legend
-    category_order = ['Total Registered Students', 'Active Students', 'Free Registered Students']
+def format_currency(value, currency='egp'):
+    symbol = currency_symbol(currency)
+    return f"{symbol} {int(value):,}"
 
-    # Chart
-    selection = alt.selection_point(fields=['Category'], bind='legend', empty='all')
 
-    line_chart = alt.Chart(melted_data).mark_line(point=True).encode(
-        x=alt.X('Year:O', title="Year"),
-        y=alt.Y('Count:Q', title="Count"),
-        color=alt.Color('Category:N', title="Category", sort=category_order,
-                        legend=alt.Legend(labelFontSize=12, labelFont='Arial', labelLimit=200, titlePadding=15)),
-        tooltip=['Year', 'Category', 'Formatted Count'],
-        opacity=alt.condition(selection, alt.value(1), alt.value(0.3))
-    ).add_params(selection)
+@instrument
+def normalize_pivot(pivot_table, axis='row'):
+    # Percentage shares of each row, each column or of the whole table, computed frame-wide and kept numeric
+    values = pivot_table.astype('float64')
+    if axis == 'row':
+        shares = values.div(values.sum(axis=1), axis=0)
+    elif axis == 'column':
+        shares = values.div(values.sum(axis=0), axis=1)
+    elif axis == 'total':
+        shares = values / values.sum().sum()
+    else:
+        raise ValueError(f"Unknown axis {axis!r}, expected 'row', 'column' or 'total'")
 
-    st.altair_chart(line_chart, use_container_width=True)
+    return (shares * 100).round(2)
 
 def get_percentage_pivot_for_same_cohort(pivot_table):
-   return (pivot_table.apply(lambda x: ((x / x.sum()) * 100).round(2), axis=1)).applymap(
-    lambda x: f"{x}%"
-    if pd.notna(x)
-    else None
-)
\ No newline at end of file
+    return normalize_pivot(pivot_table, axis='row')
+
+@instrument
+def write_pivot(pivot_table, show_percentage=False):
+    # Percentages are formatted by the browser through the column config, the frame itself stays numeric
+    if show_percentage:
+        percentage_pivot = get_percentage_pivot_for_same_cohort(pivot_table)
+        st.dataframe(percentage_pivot, column_config={
+            column: st.column_config.NumberColumn(format='%.2f%%') for column in percentage_pivot.columns
+        })
+    else:
+        st.write(pivot_table)
@@ -0,0 +1,132 @@
+from utils.data_utils import pd, prepare_cohort_base, cut_cohort_frames, get_data_version, get_current_day
+from utils.artifacts import artifact_inputs, load_artifact
+from utils.instrumentation import instrument
+from utils.snapshots import daily_snapshot
+from utils.student_dimensions import STUDENT_DIMENSIONS, prepare_student_dimensions, student_positions, gather_dimension
+
+
+ALL = 'All'
+
+CELL_KEYS = ['cohort_month', 'months_count_from_subscription']
+
+# Student attributes count each student once per cell, subscription attributes count every subscription row
+STUDENT_BREAKDOWNS = STUDENT_DIMENSIONS
+SUBSCRIPTION_BREAKDOWNS = ['currency', 'plan']
+
+# Cohort frame behind each subscription type and the pivots shown for it: name -> (value column, aggfunc)
+SUBSCRIPTION_TYPES = {
+    'Retention': {'frame': 'renewed', 'pivots': {'renewed': ('student_id', 'count'), 'renewed_revenue': ('paid_amount', 'sum')}},
+    'Churn': {'frame': 'churned', 'pivots': {'churned': ('student_id', 'count')}},
+}
+
+
+def cell_key(value):
+    # Cube keys are strings so ALL sorts and compares alongside cohort months and month counts
+    return value if value == ALL else str(value)
+
+def _cell_counts(frame, group_columns, distinct):
+    # Counts for every (cohort month, months count) cell together with its ALL roll-ups
+    frame = frame.assign(**{key: frame[key].astype(str) for key in CELL_KEYS})
+
+    counts = []
+    for rolled_up in ([], ['cohort_month'], ['months_count_from_subscription'], CELL_KEYS):
+        rolled_frame = frame.assign(**{key: ALL for key in rolled_up})
+        if distinct:
+            rolled_frame = rolled_frame.drop_duplicates(CELL_KEYS + ['student_id'])
+        counts.append(rolled_frame.groupby(CELL_KEYS + group_columns, observed=True)['student_id'].count())
+    counts = pd.concat(counts).sort_index()
+
+    # Categorical attribute levels back to plain labels for display
+    if group_columns:
+        counts.index = counts.index.set_levels(counts.index.levels[-1].astype(object), level=-1)
+
+    return counts
+
+@instrument
+def build_filter_cube(total_subs_df, renewed_df, churned_df, student_dimensions):
+    cohort_frames = {'renewed': renewed_df, 'churned': churned_df}
+
+    cube = {
+        'cohort_months': sorted(total_subs_df['cohort_month'].unique()),
+        'months_counts': sorted(total_subs_df['months_count_from_subscription'].unique()),
+    }
+    for subscription_type, spec in SUBSCRIPTION_TYPES.items():
+        frame = cohort_frames[spec['frame']]
+        positions = student_positions(student_dimensions, frame['student_id'])
+        with_students = frame[CELL_KEYS + ['student_id']].assign(**{
+            column: gather_dimension(student_dimensions, column, positions) for column in STUDENT_BREAKDOWNS
+        })
+
+        breakdowns = {column: _cell_counts(with_students, [column], distinct=True) for column in STUDENT_BREAKDOWNS}
+        breakdowns.update({column: _cell_counts(frame, [column], distinct=False) for column in SUBSCRIPTION_BREAKDOWNS})
+
+        cube[subscription_type] = {
+            'rows': _cell_counts(frame, [], distinct=False),
+            'breakdowns': breakdowns,
+            'pivots': {
+                pivot: frame.pivot_table(values=value, index='cohort_month', columns='months_count_from_subscription', aggfunc=aggfunc)
+                for pivot, (value, aggfunc) in spec['pivots'].items()
+            },
+        }
+
+    return cube
+
+def prepare_filter_cube(data_version, as_of):
+    cohort_base = prepare_cohort_base(data_version)
+    student_dimensions = prepare_student_dimensions(data_version)
+
+    # Distinct student counts do not add up across cut-offs, every day is built from its own cut
+    def build(as_of):
+        return build_filter_cube(*cut_cohort_frames(cohort_base, as_of), student_dimensions)
+
+    return daily_snapshot('filter_cube', data_version, as_of, build)
+
+@instrument
+def load_filter_cube(as_of=None):
+    data_version = get_data_version()
+    as_of = as_of or get_current_day()
+    filter_cube = load_artifact('filter_cube', artifact_inputs(data_version, as_of))
+
+    return filter_cube if filter_cube is not None else prepare_filter_cube(data_version, as_of)
+
+
+def lookup_rows_count(cube, subscription_type, cohort_month=ALL, months_count=ALL):
+    return int(cube[subscription_type]['rows'].get((cell_key(cohort_month), cell_key(months_count)), 0))
+
+@instrument
+def lookup_breakdown(cube, subscription_type, column, cohort_month=ALL, months_count=ALL):
+    # One row table of counts per value, largest first
+    counts = cube[subscription_type]['breakdowns'][column]
+    key = (cell_key(cohort_month), cell_key(months_count))
+    try:
+        counts = counts.loc[key]
+    except KeyError:
+        counts = counts.iloc[:0].droplevel([0, 1])
+
+    return breakdown_table(counts, column)
+
+def breakdown_table(counts, column):
+    table = counts.rename_axis(column).reset_index(name='count')
+    table = table.sort_values(by='count', ascending=False)
+
+    return table.set_index(column).T
+
+@instrument
+def lookup_pivot(cube, subscription_type, pivot, cohort_month=ALL, months_count=ALL):
+    # Slice of the full pivot, shaped like a pivot_table over the filtered rows
+    table = cube[subscription_type]['pivots'][pivot]
+    if cohort_month != ALL:
+        table = table.loc[table.index == cohort_month]
+    if months_count != ALL:
+        table = table.loc[:, table.columns == months_count]
+
+    return pivot_table_result(table, subscription_type, pivot)
+
+def pivot_table_result(table, subscription_type, pivot):
+    # Without empty rows and columns, counts as integers when every cell has one
+    table = table.dropna(how='all').dropna(axis=1, how='all')
+
+    if SUBSCRIPTION_TYPES[subscription_type]['pivots'][pivot][1] == 'count' and table.notna().all().all():
+        table = table.astype('int64')
+
+    return table
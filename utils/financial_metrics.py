@@ -0,0 +1,170 @@
+import os
+
+from utils.data_utils import st, pd, np, SUBSCRIPTIONS_FILE, read_subscriptions, prepare_subscriptions_frame, get_data_version
+from utils.schema import compact_integer
+from utils.streaming import STREAMING_OVERVIEW, stream_data_file, merge_distinct
+from utils.artifacts import artifact_inputs, load_artifact
+from utils.instrumentation import instrument
+
+
+FINANCIAL_SUBSCRIPTION_COLUMNS = ('student_id', 'currency', 'created_at_year', 'refund_at_year', 'paid_amount', 'remaining_amount', 'refund_amount')
+AMOUNT_KEYS = ['currency', 'created_at_year', 'refund_at_year']
+AMOUNT_COLUMNS = ['paid_amount', 'remaining_amount', 'refund_amount']
+TOTAL_COLUMNS = ['total_revenue', 'net_revenue', 'remaining_amount', 'refund_amount']
+
+# Optional local table with a `currency,rate` row per currency, rate = value of one unit in the base currency
+BASE_CURRENCY = 'egp'
+FX_RATES_PATH = os.environ.get('DASHBOARD_FX_RATES', 'fx_rates.csv')
+
+
+def amounts_partial(subscriptions_df: pd.DataFrame):
+    # Single grouped pass over the amounts, every currency total and yearly trend is rolled up from these cells.
+    # Cells and distinct (currency, student) pairs of separate batches merge into those of all their rows.
+    cells = subscriptions_df.groupby(AMOUNT_KEYS, dropna=False, observed=True)[AMOUNT_COLUMNS].sum()
+    student_currencies = subscriptions_df[['currency', 'student_id']].drop_duplicates()
+
+    # Currency labels as plain strings from here on, the cells are few
+    return {
+        'cells': cells.reset_index().astype({'currency': object}),
+        'student_currencies': student_currencies.astype({'currency': object}),
+    }
+
+def merge_amounts_partials(partials):
+    # Years as floats while merging, a batch without refunds holds an all-missing refund year
+    years = {column: 'float64' for column in AMOUNT_KEYS[1:]}
+    cells = pd.concat([partial['cells'].astype(years) for partial in partials], ignore_index=True)
+
+    return {
+        'cells': cells.groupby(AMOUNT_KEYS, dropna=False)[AMOUNT_COLUMNS].sum().reset_index(),
+        'student_currencies': merge_distinct([partial['student_currencies'] for partial in partials]),
+    }
+
+def currency_sets(student_currencies):
+    # Students per combination of currencies they paid in, the distinct students of any group of currencies add up
+    # from these few counts. Each currency is a bit of the student's mask, the (currency, student) pairs are distinct
+    currencies = pd.Categorical(student_currencies['currency'])
+    bits = pd.Series(np.left_shift(1, currencies.codes.astype('int64')))
+    masks = bits.groupby(student_currencies['student_id'].to_numpy()).sum().value_counts()
+    labels = [
+        tuple(currency for position, currency in enumerate(currencies.categories) if mask >> position & 1)
+        for mask in masks.index
+    ]
+
+    return pd.Series(masks.to_numpy(), index=labels, name='students')
+
+def finish_amounts(partial):
+    student_currencies = partial['student_currencies']
+
+    return {
+        'cells': partial['cells'],
+        'students': student_currencies['currency'].value_counts(),
+        'currency_sets': currency_sets(student_currencies),
+    }
+
+def scan_amounts(subscriptions_df: pd.DataFrame):
+    return finish_amounts(amounts_partial(subscriptions_df))
+
+@instrument
+def stream_amounts(data_version):
+    # Same scan folded out of the parquet batches, shared by the financial metrics and the KPI snapshot
+    partial = stream_data_file(data_version, SUBSCRIPTIONS_FILE, FINANCIAL_SUBSCRIPTION_COLUMNS, prepare_subscriptions_frame, amounts_partial, merge_amounts_partials)
+    # Batches compact their year columns on their own, the merged cells get the dtypes of the whole column
+    cells = partial['cells']
+    for column in AMOUNT_KEYS[1:]:
+        cells[column] = compact_integer(cells[column])
+
+    return finish_amounts(partial)
+
+def currency_totals(amounts_scan):
+    totals = amounts_scan['cells'].groupby('currency')[AMOUNT_COLUMNS].sum()
+    totals['students'] = amounts_scan['students'].reindex(totals.index).fillna(0).astype('int64')
+    totals['total_revenue'] = totals['paid_amount'] + totals['remaining_amount']
+    totals['net_revenue'] = totals['paid_amount'] - totals['refund_amount']
+    totals['arpu'] = totals['total_revenue'] / totals['students']
+
+    return totals
+
+def yearly_revenue(amounts_scan):
+    # Revenue follows the creation year, refunds the year they were paid back
+    cells = amounts_scan['cells']
+    created = cells.groupby(['currency', 'created_at_year'])[AMOUNT_COLUMNS].sum()
+    refunds = cells.dropna(subset=['refund_at_year']).astype({'refund_at_year': created.index.levels[1].dtype})
+    refunds = refunds.groupby(['currency', 'refund_at_year'])['refund_amount'].sum().rename_axis(['currency', 'created_at_year'])
+
+    yearly = pd.DataFrame({
+        'Total Revenue': created['paid_amount'] + created['remaining_amount'],
+        'Net Revenue': created['paid_amount'] - created['refund_amount'],
+        'Refund Amount': refunds.reindex(created.index).fillna(0),
+    })
+
+    return yearly.rename_axis(['currency', 'Year'])
+
+def consolidate(totals, yearly, student_currency_sets, fx_rates, base_currency=BASE_CURRENCY):
+    # Converted to the base currency, currencies without a rate are left out and reported
+    rates = fx_rates.reindex(totals.index)
+    rates[rates.index == base_currency] = 1.0
+    rates = rates.dropna()
+
+    consolidated_totals = totals.loc[rates.index, TOTAL_COLUMNS].mul(rates, axis=0).sum()
+    # Over the students who paid in at least one converted currency, like the revenue it divides
+    converted = [any(currency in rates.index for currency in currencies) for currencies in student_currency_sets.index]
+    students = student_currency_sets[converted].sum()
+    consolidated_totals['arpu'] = consolidated_totals['total_revenue'] / students if students else float('nan')
+    consolidated_yearly = yearly.loc[yearly.index.get_level_values('currency').isin(rates.index)]
+    consolidated_yearly = consolidated_yearly.mul(rates, axis=0, level='currency').groupby(level='Year').sum()
+
+    return {
+        'currency': base_currency,
+        'totals': consolidated_totals,
+        'yearly': consolidated_yearly,
+        'missing_rates': [currency for currency in totals.index if currency not in rates.index],
+    }
+
+
+def financial_metrics_from_scan(amounts_scan, fx_rates=None):
+    totals = currency_totals(amounts_scan)
+    yearly = yearly_revenue(amounts_scan)
+
+    return {
+        'currencies': totals.sort_values('total_revenue', ascending=False).index.tolist(),
+        'totals': totals,
+        'yearly': yearly,
+        'consolidated': consolidate(totals, yearly, amounts_scan['currency_sets'], fx_rates) if fx_rates is not None else None,
+    }
+
+@instrument
+def build_financial_metrics(subscriptions_df: pd.DataFrame, fx_rates=None):
+    return financial_metrics_from_scan(scan_amounts(subscriptions_df), fx_rates)
+
+def get_fx_version(path=FX_RATES_PATH):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+def read_fx_rates(path=FX_RATES_PATH):
+    fx_rates = pd.read_csv(path)
+
+    return pd.Series(fx_rates['rate'].astype('float64').to_numpy(), index=fx_rates['currency'].str.lower(), name='rate')
+
+@st.cache_data(max_entries=2)
+def prepare_amounts_scan(data_version):
+    # One grouped pass over the subscriptions per data version, read by the financial metrics and the KPI snapshot
+    if STREAMING_OVERVIEW:
+        return stream_amounts(data_version)
+
+    return scan_amounts(read_subscriptions(data_version, FINANCIAL_SUBSCRIPTION_COLUMNS))
+
+@st.cache_data(max_entries=2)
+def compute_financial_metrics(data_version, fx_version):
+    fx_rates = read_fx_rates(fx_version[0]) if fx_version else None
+
+    return financial_metrics_from_scan(prepare_amounts_scan(data_version), fx_rates)
+
+@instrument
+def load_financial_metrics():
+    data_version, fx_version = get_data_version(), get_fx_version()
+    financial_metrics = load_artifact('financial_metrics', artifact_inputs(data_version, fx_version))
+
+    return financial_metrics if financial_metrics is not None else compute_financial_metrics(data_version, fx_version)
@@ -0,0 +1,289 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+
+from utils.data_utils import pd, np, get_current_day, STUDENTS_PATH, SUBSCRIPTIONS_PATH, COHORT_SUBSCRIPTION_COLUMNS, build_cohort_frames, file_data_version
+from utils.cohort_pivots import order_attribute_columns
+from utils.artifacts import artifact_inputs
+
+
+# Also read by the Renewals Forecast when the aggregates were ingested from the data files it serves
+DEFAULT_STATE_DIR = os.environ.get('DASHBOARD_AGGREGATES', 'aggregates')
+BUCKETS_COUNT = 64
+
+HISTORY_COLUMNS = ('id',) + COHORT_SUBSCRIPTION_COLUMNS
+STUDENT_DIMENSION_COLUMNS = ('id', 'country', 'last_or_current_grade_and_module')
+
+# Persisted cohort pivots: name -> (cohort frame, pivot column, value column, aggfunc)
+COHORT_PIVOTS = {
+    'total_subs': ('total_subs', 'months_count_from_subscription', 'student_id', 'count'),
+    'renewed': ('renewed', 'months_count_from_subscription', 'student_id', 'count'),
+    'renewed_revenue': ('renewed', 'months_count_from_subscription', 'paid_amount', 'sum'),
+    'churned': ('churned', 'months_count_from_subscription', 'student_id', 'count'),
+    'country': ('total_subs', 'country', 'student_id', 'count'),
+    'grade_module': ('total_subs', 'last_or_current_grade_and_module', 'student_id', 'count'),
+    'currency': ('total_subs', 'currency', 'student_id', 'count'),
+}
+MONTHS_PIVOTS = ['total_subs', 'renewed', 'renewed_revenue', 'churned']
+
+AGGREGATE_KEYS = ['pivot', 'cohort_month', 'column']
+
+
+# --- State layout ---
+# manifest.json                 ingested partitions, the as-of date and the data version the aggregates were built for
+# aggregates.parquet            one row per pivot cell: value and number of contributing rows
+# history/NN.parquet            subscription history, bucketed by student_id
+# contributions/NN.parquet      per-student pivot cell contributions, bucketed by student_id
+# pending_expiries.parquet      subscriptions expiring on or after the as-of date
+# student_dimensions.parquet    student attributes the dimension pivots were built with
+
+def _state_path(state_dir, *parts):
+    return os.path.join(state_dir, *parts)
+
+def _bucket_path(state_dir, kind, bucket):
+    return _state_path(state_dir, kind, f'{bucket:02d}.parquet')
+
+def read_manifest(state_dir=DEFAULT_STATE_DIR):
+    path = _state_path(state_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {'as_of': None, 'partitions': []}
+
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+def _write_manifest(state_dir, manifest):
+    with open(_state_path(state_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+def _read_state_frame(path, columns=None):
+    if not os.path.exists(path):
+        return None
+
+    return pd.read_parquet(path, columns=columns)
+
+def _empty_aggregates():
+    return pd.DataFrame({'pivot': pd.Series(dtype=str), 'cohort_month': pd.Series(dtype=str), 'column': pd.Series(dtype=str),
+                         'value': pd.Series(dtype=float), 'rows': pd.Series(dtype='int64')})
+
+def _empty_contributions():
+    return _empty_aggregates().assign(student_id=pd.Series(dtype=str))
+
+
+def student_buckets(student_ids):
+    # Stable across processes, unlike the builtin hash()
+    return (pd.util.hash_pandas_object(pd.Series(student_ids), index=False).to_numpy() % BUCKETS_COUNT).astype('int64')
+
+def discover_partitions(paths):
+    # Accepts parquet files and directories, e.g. a date-partitioned subscriptions/date=YYYY-MM-DD/ tree
+    partitions = []
+    for path in paths:
+        if os.path.isdir(path):
+            partitions.extend(sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True)))
+        else:
+            partitions.append(path)
+
+    return [os.path.normpath(partition) for partition in partitions]
+
+
+def compute_contributions(history_df, student_dimensions_df, as_of):
+    # Per-student pivot cells; every cohort pivot is a sum of these, so students can be swapped in and out independently
+    total_subs_df, renewed_df, churned_df = build_cohort_frames(history_df, as_of)
+    total_subs_df = total_subs_df.merge(student_dimensions_df, left_on='student_id', right_on='id', how='left', suffixes=('', '_student'))
+    cohort_frames = {'total_subs': total_subs_df, 'renewed': renewed_df, 'churned': churned_df}
+
+    contributions = [_empty_contributions()]
+    for pivot, (frame_name, column, value, aggfunc) in COHORT_PIVOTS.items():
+        frame = cohort_frames[frame_name].dropna(subset=[column])
+        if frame.empty:
+            continue
+        cells = frame.groupby(['student_id', 'cohort_month', column]).agg(value=(value, aggfunc), rows=(value, 'size')).reset_index()
+        contributions.append(pd.DataFrame({
+            'pivot': pivot,
+            'cohort_month': cells['cohort_month'].astype(str),
+            'column': cells[column].astype(str),
+            'value': cells['value'].astype(float),
+            'rows': cells['rows'].astype('int64'),
+            'student_id': cells['student_id'],
+        }))
+
+    return pd.concat(contributions, ignore_index=True)
+
+def _sum_cells(contributions_df):
+    return contributions_df.groupby(AGGREGATE_KEYS)[['value', 'rows']].sum()
+
+def _apply_delta(aggregates_df, removed_df, added_df):
+    aggregates = _sum_cells(aggregates_df)
+    delta = _sum_cells(added_df).sub(_sum_cells(removed_df), fill_value=0)
+    aggregates = aggregates.add(delta, fill_value=0)
+    aggregates = aggregates[aggregates['rows'] > 0]
+    aggregates['rows'] = aggregates['rows'].astype('int64')
+
+    return aggregates.reset_index()
+
+
+def ingest_partitions(paths, state_dir=DEFAULT_STATE_DIR, as_of=None, students_path=STUDENTS_PATH):
+    as_of = as_of or get_current_day()
+    manifest = read_manifest(state_dir)
+    os.makedirs(_state_path(state_dir, 'history'), exist_ok=True)
+    os.makedirs(_state_path(state_dir, 'contributions'), exist_ok=True)
+    # Readers stop using the aggregates until they are complete again
+    source_paths = tuple(os.path.normpath(path) for path in [students_path] + list(paths))
+    source_version = file_data_version(source_paths)
+    _write_manifest(state_dir, {**manifest, 'data_version': None})
+
+    new_partitions = [partition for partition in discover_partitions(paths) if partition not in manifest['partitions']]
+    new_subs = [pd.read_parquet(partition, columns=list(HISTORY_COLUMNS)) for partition in new_partitions]
+    new_subs_df = pd.concat(new_subs, ignore_index=True) if new_subs else pd.DataFrame(columns=list(HISTORY_COLUMNS))
+
+    # Students touched by the new rows
+    affected_ids = set(new_subs_df['student_id'])
+
+    # Students with a subscription expiring between the previous and the new as-of date
+    pending_expiries_df = _read_state_frame(_state_path(state_dir, 'pending_expiries.parquet'))
+    if pending_expiries_df is not None:
+        affected_ids |= set(pending_expiries_df.loc[pending_expiries_df['expired_at'] < as_of, 'student_id'])
+
+    # Students whose country or grade changed since their contributions were computed
+    student_dimensions_df = pd.read_parquet(students_path, columns=list(STUDENT_DIMENSION_COLUMNS))
+    previous_dimensions_df = _read_state_frame(_state_path(state_dir, 'student_dimensions.parquet'))
+    if previous_dimensions_df is not None:
+        compared = student_dimensions_df.merge(previous_dimensions_df, on='id', how='outer', suffixes=('', '_previous'), indicator=True)
+        changed = compared['_merge'] != 'both'
+        for column in STUDENT_DIMENSION_COLUMNS[1:]:
+            changed |= ~((compared[column] == compared[f'{column}_previous']) | (compared[column].isna() & compared[f'{column}_previous'].isna()))
+        affected_ids |= set(compared.loc[changed, 'id'])
+
+    aggregates_df = _read_state_frame(_state_path(state_dir, 'aggregates.parquet'))
+    aggregates_df = aggregates_df if aggregates_df is not None else _empty_aggregates()
+
+    affected_ids = pd.Series(sorted(affected_ids), dtype=object)
+    affected_buckets = student_buckets(affected_ids)
+    new_subs_buckets = student_buckets(new_subs_df['student_id'])
+    removed, added, expiries = [], [], []
+    for bucket in np.unique(affected_buckets):
+        bucket_ids = set(affected_ids[affected_buckets == bucket])
+
+        # Upsert the bucket's history, newer rows replace older versions of the same subscription
+        history_df = _read_state_frame(_bucket_path(state_dir, 'history', bucket))
+        bucket_new_subs_df = new_subs_df[new_subs_buckets == bucket]
+        if len(bucket_new_subs_df):
+            history_df = pd.concat([history_df, bucket_new_subs_df], ignore_index=True) if history_df is not None else bucket_new_subs_df
+            history_df = history_df.drop_duplicates(subset='id', keep='last').reset_index(drop=True)
+            history_df.to_parquet(_bucket_path(state_dir, 'history', bucket), index=False)
+        if history_df is None:
+            continue
+
+        # Swap the affected students' contributions
+        contributions_df = _read_state_frame(_bucket_path(state_dir, 'contributions', bucket))
+        contributions_df = contributions_df if contributions_df is not None else _empty_contributions()
+        is_affected = contributions_df['student_id'].isin(bucket_ids)
+        students_history_df = history_df[history_df['student_id'].isin(bucket_ids)]
+        bucket_added_df = compute_contributions(students_history_df, student_dimensions_df, as_of)
+        removed.append(contributions_df[is_affected])
+        added.append(bucket_added_df)
+        pd.concat([contributions_df[~is_affected], bucket_added_df], ignore_index=True).to_parquet(
+            _bucket_path(state_dir, 'contributions', bucket), index=False)
+
+        expiries.append(students_history_df.loc[students_history_df['expired_at'] >= as_of, ['student_id', 'expired_at']])
+
+    if removed:
+        aggregates_df = _apply_delta(aggregates_df, pd.concat(removed), pd.concat(added))
+
+    # Pending expiries of untouched students are kept, the affected ones were recomputed above
+    if pending_expiries_df is not None:
+        expiries.append(pending_expiries_df[~pending_expiries_df['student_id'].isin(affected_ids) & (pending_expiries_df['expired_at'] >= as_of)])
+    if expiries:
+        pd.concat(expiries, ignore_index=True).to_parquet(_state_path(state_dir, 'pending_expiries.parquet'), index=False)
+
+    aggregates_df.to_parquet(_state_path(state_dir, 'aggregates.parquet'), index=False)
+    student_dimensions_df.to_parquet(_state_path(state_dir, 'student_dimensions.parquet'), index=False)
+    manifest['partitions'] = manifest['partitions'] + new_partitions
+    manifest['as_of'] = pd.Timestamp(as_of).isoformat()
+    # Files replaced while ingesting: the aggregates match neither version and are not served
+    manifest['data_version'] = artifact_inputs(source_version) if file_data_version(source_paths) == source_version else None
+    _write_manifest(state_dir, manifest)
+
+    return {'partitions': len(new_partitions), 'rows': len(new_subs_df), 'students': len(affected_ids)}
+
+def rebuild_aggregates(paths, state_dir=DEFAULT_STATE_DIR, as_of=None, students_path=STUDENTS_PATH):
+    # Full recomputation from scratch, used to verify the incremental state
+    if os.path.exists(state_dir):
+        shutil.rmtree(state_dir)
+
+    return ingest_partitions(paths, state_dir, as_of, students_path)
+
+
+def load_aggregate_pivots(state_dir=DEFAULT_STATE_DIR):
+    # Same shape as the pivot_table calls on the Renewals Forecast page
+    aggregates_df = pd.read_parquet(_state_path(state_dir, 'aggregates.parquet'))
+
+    pivots = {}
+    for pivot in COHORT_PIVOTS:
+        cells = aggregates_df[aggregates_df['pivot'] == pivot]
+        if pivot in MONTHS_PIVOTS:
+            cells = cells.assign(column=cells['column'].astype(float))
+        table = cells.pivot(index='cohort_month', columns='column', values='value')
+        table.index = pd.PeriodIndex(table.index, freq='M', name='cohort_month')
+        table.columns.name = COHORT_PIVOTS[pivot][1]
+        table = table.sort_index().sort_index(axis=1)
+        if pivot not in MONTHS_PIVOTS:
+            table = order_attribute_columns(table.fillna(0).astype('int64'))
+        pivots[pivot] = table
+
+    return pivots
+
+def load_ingested_pivots(data_version, as_of, state_dir=DEFAULT_STATE_DIR):
+    # The aggregate pivots when they were ingested from the files of data_version for the same as-of date, none
+    # otherwise. The manifest is checked again after reading, an ingest started meanwhile discards what was read
+    def matches():
+        manifest = read_manifest(state_dir)
+        return (manifest.get('data_version') == artifact_inputs(data_version) and manifest['as_of'] is not None
+                and pd.Timestamp(manifest['as_of']) == pd.Timestamp(as_of))
+
+    if not matches():
+        return {}
+    pivots = load_aggregate_pivots(state_dir)
+
+    return pivots if matches() else {}
+
+def verify_aggregates(paths, state_dir=DEFAULT_STATE_DIR, students_path=STUDENTS_PATH):
+    # Rebuilds into a scratch directory for the same as-of date and compares every pivot
+    manifest = read_manifest(state_dir)
+    scratch_dir = f'{state_dir.rstrip(os.sep)}_verify'
+    rebuild_aggregates(paths, scratch_dir, pd.Timestamp(manifest['as_of']), students_path)
+
+    incremental, rebuilt = load_aggregate_pivots(state_dir), load_aggregate_pivots(scratch_dir)
+    mismatches = []
+    for pivot in COHORT_PIVOTS:
+        try:
+            pd.testing.assert_frame_equal(incremental[pivot], rebuilt[pivot], check_dtype=False)
+        except AssertionError:
+            mismatches.append(pivot)
+    shutil.rmtree(scratch_dir)
+
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge new subscription partitions into the persisted cohort aggregates.')
+    parser.add_argument('paths', nargs='*', default=[SUBSCRIPTIONS_PATH], help='parquet files or partition directories')
+    parser.add_argument('--state-dir', default=DEFAULT_STATE_DIR)
+    parser.add_argument('--students', default=STUDENTS_PATH)
+    parser.add_argument('--rebuild', action='store_true', help='discard the state and recompute everything')
+    parser.add_argument('--verify', action='store_true', help='compare the incremental state with a full rebuild')
+    args = parser.parse_args()
+
+    if args.verify:
+        mismatches = verify_aggregates(args.paths, args.state_dir, args.students)
+        print('Aggregates match a full rebuild' if not mismatches else f"Mismatched pivots: {', '.join(mismatches)}")
+        raise SystemExit(1 if mismatches else 0)
+
+    ingest = rebuild_aggregates if args.rebuild else ingest_partitions
+    summary = ingest(args.paths, args.state_dir, students_path=args.students)
+    print(f"Ingested {summary['partitions']} partitions ({summary['rows']} rows), recomputed {summary['students']} students")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import pandas as pd
+import streamlit as st
+
+from utils.result_cache import result_cache_stats
+
+
+# Enabled with DASHBOARD_PROFILE=1, records are also appended as JSON lines to DASHBOARD_PROFILE_LOG
+PROFILING_ENABLED = os.environ.get('DASHBOARD_PROFILE', '') not in ('', '0', 'false')
+PROFILE_LOG_PATH = os.environ.get('DASHBOARD_PROFILE_LOG', 'profile.jsonl')
+
+_local = threading.local()
+
+# tracemalloc keeps one peak for the whole process: stages open on other threads at the same time (worker jobs, the
+# background refresh, other sessions) share it, their peaks are not recorded
+_memory_lock = threading.Lock()
+_open_stacks = {}
+
+profile_logger = logging.getLogger('dashboard.profile')
+if PROFILING_ENABLED and not profile_logger.handlers:
+    log_handler = logging.FileHandler(PROFILE_LOG_PATH)
+    log_handler.setFormatter(logging.Formatter('%(message)s'))
+    profile_logger.addHandler(log_handler)
+    profile_logger.setLevel(logging.INFO)
+    profile_logger.propagate = False
+    tracemalloc.start()
+
+
+def _state():
+    # Records and open stages of the script run executing on this thread
+    if not hasattr(_local, 'records'):
+        _local.records, _local.stack, _local.page = [], [], None
+
+    return _local
+
+def count_rows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        counts = [count_rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+
+    return None
+
+def start_profile_run(page):
+    state = _state()
+    state.records, state.stack, state.page = [], [], page
+
+
+@contextmanager
+def profile_stage(name, rows_in=None):
+    # The yielded record accepts a rows_out value set by the caller
+    if not PROFILING_ENABLED:
+        yield {}
+        return
+
+    state = _state()
+    record = {'stage': name, 'page': state.page, 'depth': len(state.stack), 'rows_in': rows_in, 'rows_out': None}
+    state.records.append(record)
+
+    # tracemalloc keeps a single peak, every open stage keeps its own running maximum across nested resets.
+    # A stage overlapping one of another thread marks every open stage as shared, none of them resets the peak again
+    thread_id = threading.get_ident()
+    with _memory_lock:
+        shared = any(stack for stack_thread, stack in _open_stacks.items() if stack_thread != thread_id)
+        start_memory = None
+        if shared:
+            for stack in _open_stacks.values():
+                for entry in stack:
+                    entry[2] = True
+        else:
+            if state.stack:
+                state.stack[-1][1] = max(state.stack[-1][1], tracemalloc.get_traced_memory()[1])
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        state.stack.append([record, 0, shared])
+        _open_stacks[thread_id] = state.stack
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        with _memory_lock:
+            _, peak_memory, shared = state.stack.pop()
+            if shared:
+                record['peak_bytes'] = None
+            else:
+                peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+                record['peak_bytes'] = peak_memory - start_memory
+                if state.stack:
+                    state.stack[-1][1] = max(state.stack[-1][1], peak_memory)
+            if not state.stack:
+                _open_stacks.pop(thread_id, None)
+        record['finished_at'] = datetime.now(timezone.utc).isoformat()
+        profile_logger.info(json.dumps(record, default=str))
+
+def instrument(func=None, name=None):
+    # Usable as @instrument or @instrument(name='...'), a plain call when profiling is disabled
+    if func is None:
+        return functools.partial(instrument, name=name)
+
+    stage_name = name or f'{func.__module__.split(".")[-1]}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILING_ENABLED:
+            return func(*args, **kwargs)
+
+        with profile_stage(stage_name, count_rows(list(args) + list(kwargs.values()))) as record:
+            result = func(*args, **kwargs)
+            record['rows_out'] = count_rows(result)
+
+        return result
+
+    return wrapper
+
+
+def get_profile_records():
+    return list(_state().records)
+
+def profiled_task(func):
+    # Wraps func for a worker thread, its stages are recorded under the submitting page and returned with the result
+    page = _state().page
+
+    def task(*args, **kwargs):
+        start_profile_run(page)
+        return func(*args, **kwargs), get_profile_records()
+
+    return task
+
+def adopt_profile_records(records):
+    # Stages of a worker thread, nested under the stage open on this thread
+    state = _state()
+    for record in records:
+        state.records.append({**record, 'depth': record['depth'] + len(state.stack)})
+
+def render_debug_panel():
+    if not PROFILING_ENABLED:
+        return
+
+    records = get_profile_records()
+    with st.sidebar.expander("⏱️ Debug: stage timings", expanded=False):
+        cache_stats = result_cache_stats()
+        st.caption(
+            f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions, "
+            f"{cache_stats['entries']} tables in {cache_stats['bytes'] / 2 ** 20:.1f} of {cache_stats['max_bytes'] / 2 ** 20:.0f} MB"
+        )
+        if not records:
+            st.write("No stages recorded in this run.")
+            return
+        timings = pd.DataFrame(records)[['stage', 'depth', 'seconds', 'rows_in', 'rows_out', 'peak_bytes']]
+        timings['stage'] = ['· ' * depth + stage for stage, depth in zip(timings['stage'], timings['depth'])]
+        timings['peak_mb'] = (timings['peak_bytes'].astype('float64') / 2 ** 20).round(2)
+        st.dataframe(timings.drop(columns=['depth', 'peak_bytes']), hide_index=True)
+        st.caption(
+            "Peak memory is left empty for stages that ran alongside stages of other threads (worker jobs, the "
+            f"background refresh, other sessions): the process keeps a single peak. Also logged to {PROFILE_LOG_PATH}"
+        )
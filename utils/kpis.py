@@ -0,0 +1,165 @@
+from dataclasses import dataclass, field
+
+from utils.data_utils import st, pd, STUDENTS_FILE, read_students, prepare_students_frame, get_data_version
+from utils.financial_metrics import scan_amounts, currency_totals, prepare_amounts_scan
+from utils.streaming import STREAMING_OVERVIEW, stream_data_file, merge_counts
+from utils.artifacts import artifact_inputs, load_artifact
+from utils.instrumentation import instrument
+
+
+KPI_STUDENT_COLUMNS = ('id', 'status')
+
+NON_CHURNED_STATUSES = ['active', 'pending_schedule', 'pending']
+CHURNED_STATUSES = ['expired', 'canceled']
+
+# Registered metrics, each one is computed from the shared scan results instead of scanning the tables again
+KPI_REGISTRY = {}
+
+def register_kpi(name):
+    def decorator(func):
+        KPI_REGISTRY[name] = func
+        return func
+
+    return decorator
+
+
+@dataclass(frozen=True)
+class KpiSnapshot:
+    total_revenue: float
+    net_revenue: float
+    remaining_amount: float
+    refunded_amount: float
+    arpu: float
+    total_students: int
+    free_students: int
+    active_students: int
+    inactive_students: int
+    pending_students: int
+    expired_students: int
+    canceled_students: int
+    churn_rate: float
+    # Metrics registered outside this module, keyed by their registry name
+    extra_metrics: dict = field(default_factory=dict)
+
+
+def scan_students(students_df: pd.DataFrame):
+    # Single pass over the status column, scans of separate batches add up
+    return {
+        'total': students_df['id'].shape[0],
+        'status_counts': students_df['status'].value_counts(),
+    }
+
+def merge_students_scans(scans):
+    return {
+        'total': sum(scan['total'] for scan in scans),
+        'status_counts': merge_counts([scan['status_counts'].rename_axis(None).astype('int64') for scan in scans]),
+    }
+
+def scan_subscriptions(subscriptions_df: pd.DataFrame):
+    # Per-currency totals of the financial metrics engine
+    return {'currency_totals': currency_totals(scan_amounts(subscriptions_df))}
+
+
+def _status_count(students_scan, status):
+    return int(students_scan['status_counts'].get(status, 0))
+
+def _currency_total(subscriptions_scan, column, currency='egp'):
+    currency_totals = subscriptions_scan['currency_totals']
+    if currency not in currency_totals.index:
+        return 0
+
+    return currency_totals.at[currency, column]
+
+
+@register_kpi('total_revenue')
+def _total_revenue(students_scan, subscriptions_scan):
+    return _currency_total(subscriptions_scan, 'paid_amount') + _currency_total(subscriptions_scan, 'remaining_amount')
+
+@register_kpi('net_revenue')
+def _net_revenue(students_scan, subscriptions_scan):
+    return _currency_total(subscriptions_scan, 'paid_amount') - _currency_total(subscriptions_scan, 'refund_amount')
+
+@register_kpi('remaining_amount')
+def _remaining_amount(students_scan, subscriptions_scan):
+    return _currency_total(subscriptions_scan, 'remaining_amount')
+
+@register_kpi('refunded_amount')
+def _refunded_amount(students_scan, subscriptions_scan):
+    return _currency_total(subscriptions_scan, 'refund_amount')
+
+@register_kpi('arpu')
+def _arpu(students_scan, subscriptions_scan):
+    # No subscriptions in the currency: NaN like the per-currency ARPU, not a division by zero
+    students = _currency_total(subscriptions_scan, 'students')
+    if students == 0:
+        return float('nan')
+
+    return _total_revenue(students_scan, subscriptions_scan) / students
+
+@register_kpi('total_students')
+def _total_students(students_scan, subscriptions_scan):
+    return students_scan['total']
+
+@register_kpi('free_students')
+def _free_students(students_scan, subscriptions_scan):
+    return _status_count(students_scan, 'free')
+
+@register_kpi('active_students')
+def _active_students(students_scan, subscriptions_scan):
+    return _status_count(students_scan, 'active')
+
+@register_kpi('inactive_students')
+def _inactive_students(students_scan, subscriptions_scan):
+    return _status_count(students_scan, 'pending_schedule')
+
+@register_kpi('pending_students')
+def _pending_students(students_scan, subscriptions_scan):
+    return _status_count(students_scan, 'pending')
+
+@register_kpi('expired_students')
+def _expired_students(students_scan, subscriptions_scan):
+    return _status_count(students_scan, 'expired')
+
+@register_kpi('canceled_students')
+def _canceled_students(students_scan, subscriptions_scan):
+    return _status_count(students_scan, 'canceled')
+
+@register_kpi('churn_rate')
+def _churn_rate(students_scan, subscriptions_scan):
+    total_churned_students = sum(_status_count(students_scan, status) for status in CHURNED_STATUSES)
+    total_paid_students = total_churned_students + sum(_status_count(students_scan, status) for status in NON_CHURNED_STATUSES)
+
+    return total_churned_students / total_paid_students * 100
+
+
+def kpi_snapshot_from_scans(students_scan, subscriptions_scan):
+    values = {name: metric(students_scan, subscriptions_scan) for name, metric in KPI_REGISTRY.items()}
+    snapshot_fields = set(KpiSnapshot.__dataclass_fields__) - {'extra_metrics'}
+    extra_metrics = {name: value for name, value in values.items() if name not in snapshot_fields}
+
+    return KpiSnapshot(**{name: values[name] for name in snapshot_fields}, extra_metrics=extra_metrics)
+
+@instrument
+def build_kpi_snapshot(students_df: pd.DataFrame, subscriptions_df: pd.DataFrame):
+    return kpi_snapshot_from_scans(scan_students(students_df), scan_subscriptions(subscriptions_df))
+
+@instrument
+def stream_students_scan(data_version):
+    return stream_data_file(data_version, STUDENTS_FILE, KPI_STUDENT_COLUMNS, prepare_students_frame, scan_students, merge_students_scans)
+
+@st.cache_data(max_entries=2)
+def compute_kpi_snapshot(data_version):
+    students_scan = stream_students_scan(data_version) if STREAMING_OVERVIEW else scan_students(read_students(data_version, KPI_STUDENT_COLUMNS))
+    # Subscription KPIs come from the amounts scan of the financial metrics, the subscriptions are grouped once
+    subscriptions_scan = {'currency_totals': currency_totals(prepare_amounts_scan(data_version))}
+
+    return kpi_snapshot_from_scans(students_scan, subscriptions_scan)
+
+@instrument
+def load_kpi_snapshot():
+    data_version = get_data_version()
+    snapshot_values = load_artifact('kpi_snapshot', artifact_inputs(data_version))
+    if snapshot_values is not None:
+        return KpiSnapshot(**snapshot_values)
+
+    return compute_kpi_snapshot(data_version)
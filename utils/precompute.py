@@ -0,0 +1,54 @@
+import argparse
+import dataclasses
+import logging
+from datetime import datetime
+
+# Cached helpers run without a Streamlit runtime here, silence the "no runtime" warnings
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+from utils.data_utils import cairo, get_current_day, get_data_version
+from utils.kpis import compute_kpi_snapshot
+from utils.financial_metrics import get_fx_version, compute_financial_metrics
+from utils.query_backend import QUERY_BACKEND, prepare_forecast_pivots
+from utils.filter_cube import prepare_filter_cube
+from utils.survival_forecast import prepare_survival_forecast
+from utils.trends import prepare_trend_rollups
+from utils.artifacts import ARTIFACTS_DIR, artifact_inputs, write_artifacts
+
+
+def materialize(as_of=None, artifacts_dir=ARTIFACTS_DIR, keep=3):
+    # Every table the three dashboards display, computed by the same functions the pages fall back to
+    as_of = as_of or get_current_day()
+    data_version = get_data_version()
+    fx_version = get_fx_version()
+
+    artifacts = {
+        # Dashboard Overview (app.py)
+        'kpi_snapshot': (artifact_inputs(data_version), dataclasses.asdict(compute_kpi_snapshot(data_version))),
+        'financial_metrics': (artifact_inputs(data_version, fx_version), compute_financial_metrics(data_version, fx_version)),
+        'trend_rollups': (artifact_inputs(data_version), prepare_trend_rollups(data_version)),
+        # Renewals Forecast (pages/00 subscriptions_analysis.py)
+        'forecast_pivots': (artifact_inputs(data_version, as_of), prepare_forecast_pivots(QUERY_BACKEND, data_version, as_of)),
+        'survival_forecast': (artifact_inputs(data_version, as_of), prepare_survival_forecast(data_version, as_of)),
+        # Filter Viewer (pages/filters.py)
+        'filter_cube': (artifact_inputs(data_version, as_of), prepare_filter_cube(data_version, as_of)),
+    }
+
+    return write_artifacts(artifacts, artifacts_dir, keep)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Materialize the dashboard tables so page loads only read them.')
+    parser.add_argument('--as-of', help='cohort cut-off date YYYY-MM-DD, defaults to today (Africa/Cairo)')
+    parser.add_argument('--artifacts-dir', default=ARTIFACTS_DIR)
+    parser.add_argument('--keep', type=int, default=3, help='versions kept on disk, including the new one')
+    args = parser.parse_args()
+
+    as_of = cairo.localize(datetime.strptime(args.as_of, '%Y-%m-%d')) if args.as_of else None
+    manifest = materialize(as_of, args.artifacts_dir, max(args.keep, 1))
+    tables = sum(len(artifact['tables']) for artifact in manifest['artifacts'].values())
+    print(f"Wrote version {manifest['version']} with {len(manifest['artifacts'])} artifacts ({tables} tables) to {args.artifacts_dir}")
+
+
+if __name__ == '__main__':
+    main()
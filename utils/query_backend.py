@@ -0,0 +1,261 @@
+import argparse
+import logging
+import os
+import threading
+
+from utils.data_utils import st, pd, cairo, get_current_day, STUDENTS_FILE, SUBSCRIPTIONS_FILE, check_data_file, get_data_version, prepare_cohort_base, cut_cohort_frames
+from utils.student_dimensions import prepare_student_dimensions
+from utils.cohort_pivots import FORECAST_PIVOTS, select_forecast_pivots, cohort_pivot, attribute_pivot, cohort_student_counts, build_forecast_pivots, update_forecast_pivots, order_attribute_columns
+from utils.artifacts import artifact_inputs, load_artifact
+from utils.instrumentation import instrument, profile_stage
+from utils.ingest import load_ingested_pivots
+from utils.snapshots import SNAPSHOT_DAYS, SNAPSHOT_VERSIONS, daily_snapshot, snapshot_days
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+# pandas (reference, in memory) or duckdb (runs over the parquet files, spills to disk and uses every core)
+QUERY_BACKEND = os.environ.get('DASHBOARD_BACKEND', 'pandas')
+
+backend_logger = logging.getLogger('dashboard.query_backend')
+
+
+class PandasBackend:
+    name = 'pandas'
+
+    def forecast_pivots(self, data_version, as_of, names=None):
+        pivots = select_forecast_pivots(names)
+        # Every pivot prepared at once for the day (in parallel, e.g. by the refresher): subsets are read from it
+        if names is not None and as_of in snapshot_days(('forecast_pivots', tuple(FORECAST_PIVOTS)), data_version):
+            every_pivot = self.forecast_pivots(data_version, as_of)
+            return {name: every_pivot[name] for name in pivots}
+        cohort_base = prepare_cohort_base(data_version)
+        student_dimensions = prepare_student_dimensions(data_version)
+
+        def build(as_of):
+            return build_forecast_pivots(*cut_cohort_frames(cohort_base, as_of), student_dimensions, pivots)
+
+        def update(previous_as_of, previous_pivots, as_of):
+            # Only the cohort rows between the two cut-offs are aggregated
+            delta_frames = cut_cohort_frames(cohort_base, as_of, since=previous_as_of)
+            return update_forecast_pivots(previous_pivots, cut_cohort_frames(cohort_base, as_of), delta_frames, student_dimensions, pivots)
+
+        # Each subset of pivots keeps its own days
+        return daily_snapshot(('forecast_pivots', tuple(pivots)), data_version, as_of, build, update)
+
+
+# Same derivation as build_cohort_frames: subscriptions numbered in created_at order, then walked in expired_at order.
+# Loaded once per data version, every cut-off day is derived from these tables without reading the files again
+COHORT_BASE_SQL = """
+CREATE TABLE ordered AS
+SELECT
+    student_id, created_at, expired_at, currency, paid_amount,
+    row_number() OVER (PARTITION BY student_id ORDER BY created_at, file_row_number) - 1 AS subscription_count,
+    min(created_at) OVER (PARTITION BY student_id) AS subscribed_at
+FROM read_parquet($subscriptions_path, file_row_number = true);
+
+CREATE TABLE sequenced AS
+SELECT
+    *,
+    lag(expired_at) OVER (PARTITION BY student_id ORDER BY expired_at, subscription_count) AS previous_expired_at,
+    row_number() OVER (PARTITION BY student_id ORDER BY expired_at DESC, subscription_count DESC) = 1 AS is_last
+FROM ordered;
+
+DROP TABLE ordered;
+
+CREATE TABLE students AS
+SELECT id, country, last_or_current_grade_and_module FROM read_parquet($students_path);
+"""
+
+# Cohort frames of a cut-off day, temporary tables of the day's own connection
+COHORT_FRAMES_SQL = """
+CREATE TEMP TABLE total_subs AS
+SELECT *, {cohort_month} AS cohort_month, {months_count} AS months_count_from_subscription
+FROM (SELECT *, expired_at AS cohort_at FROM sequenced WHERE expired_at < $as_of);
+
+CREATE TEMP TABLE renewed AS
+SELECT *, {cohort_month} AS cohort_month, {months_count} AS months_count_from_subscription
+FROM (SELECT *, previous_expired_at AS cohort_at FROM sequenced WHERE previous_expired_at < $as_of);
+
+CREATE TEMP TABLE churned AS
+SELECT *, {cohort_month} AS cohort_month, {months_count} AS months_count_from_subscription
+FROM (SELECT *, expired_at AS cohort_at FROM sequenced WHERE is_last AND expired_at < $as_of);
+
+CREATE TEMP TABLE subs_with_info AS
+SELECT total_subs.*, students.country, students.last_or_current_grade_and_module
+FROM total_subs LEFT JOIN students ON students.id = total_subs.student_id;
+"""
+
+# Local calendar month and whole days / 30 rounded half to even, like dt.to_period('M') and Series.round()
+COHORT_MONTH_SQL = f"strftime(timezone('{cairo.zone}', cohort_at), '%Y-%m')"
+MONTHS_COUNT_SQL = "round_even(floor(datediff('microsecond', subscribed_at, cohort_at) / 86400000000) / 30, 0)"
+
+
+def execute_script(connection, sql, parameters):
+    for statement in filter(str.strip, sql.split(';')):
+        connection.execute(statement, {name: value for name, value in parameters.items() if f'${name}' in statement})
+
+@st.cache_resource(max_entries=SNAPSHOT_VERSIONS)
+def load_duckdb_cohort_base(data_version, threads=None):
+    # In-memory database of one data version, read from the files the version names. A file replaced or still
+    # being copied no longer matches the version and fails the load instead of being read under its name
+    students_path, subscriptions_path = check_data_file(data_version, STUDENTS_FILE), check_data_file(data_version, SUBSCRIPTIONS_FILE)
+
+    connection = duckdb.connect()
+    if threads:
+        connection.execute(f"SET threads = {int(threads)}")
+    execute_script(connection, COHORT_BASE_SQL, {'subscriptions_path': subscriptions_path, 'students_path': students_path})
+    try:
+        check_data_file(data_version, STUDENTS_FILE)
+        check_data_file(data_version, SUBSCRIPTIONS_FILE)
+    except RuntimeError:
+        connection.close()
+        raise
+
+    return connection
+
+
+class DuckDBBackend:
+    name = 'duckdb'
+
+    def __init__(self, threads=None):
+        if duckdb is None:
+            raise ImportError("The duckdb query backend needs the duckdb package: pip install duckdb")
+        self.threads = threads
+
+    def _cohort_frames(self, data_version, as_of):
+        # One connection holding the materialized cohort frames per data version and day, shared by every pivot and
+        # session. DuckDB connections are not thread-safe, queries on it take its lock
+        def build(as_of):
+            # A cursor shares the version's tables and keeps its own temporary ones
+            connection = load_duckdb_cohort_base(data_version, self.threads).cursor()
+            sql = COHORT_FRAMES_SQL.format(cohort_month=COHORT_MONTH_SQL, months_count=MONTHS_COUNT_SQL)
+            execute_script(connection, sql, {'as_of': as_of})
+            return connection, threading.Lock()
+
+        return daily_snapshot(('duckdb_cohort_frames', self.threads), data_version, as_of, build)
+
+    def _cells(self, connection, frame, column, value='student_id', aggfunc='count'):
+        aggregate = 'count(student_id)' if aggfunc == 'count' else f'coalesce(sum({value}), 0)'
+        column_filter = f'WHERE {column} IS NOT NULL' if column else ''
+        group_column = f', {column} AS column_value' if column else ''
+
+        return connection.execute(
+            f"SELECT cohort_month{group_column}, {aggregate} AS value FROM {frame} {column_filter} GROUP BY ALL"
+        ).df()
+
+    def _pivot(self, cells, column, aggfunc, fill_value=None):
+        # Long cells to the wide layout and dtypes pivot_table produces
+        table = cells.pivot(index='cohort_month', columns='column_value', values='value')
+        table.index = pd.PeriodIndex(table.index, freq='M', name='cohort_month')
+        table.columns.name = column
+        table = table.sort_index().sort_index(axis=1)
+        if fill_value is not None:
+            table = table.fillna(fill_value)
+        if aggfunc == 'count' and table.notna().all().all():
+            table = table.astype('int64')
+
+        return table
+
+    def forecast_pivots(self, data_version, as_of, names=None):
+        connection, lock = self._cohort_frames(data_version, as_of)
+        pivots = select_forecast_pivots(names)
+
+        forecast_pivots, untranslated = {}, []
+        for name, (function, frame, kwargs) in pivots.items():
+            if function not in (cohort_pivot, attribute_pivot, cohort_student_counts):
+                untranslated.append(name)
+                continue
+            with profile_stage(f'pivot.{name}') as record, lock:
+                if function is cohort_pivot:
+                    column = kwargs.get('columns', 'months_count_from_subscription')
+                    aggfunc = kwargs.get('aggfunc', 'count')
+                    cells = self._cells(connection, frame, column, kwargs.get('values', 'student_id'), aggfunc)
+                    forecast_pivots[name] = self._pivot(cells, column, aggfunc)
+                elif function is attribute_pivot:
+                    cells = self._cells(connection, frame, kwargs['column'])
+                    forecast_pivots[name] = order_attribute_columns(self._pivot(cells, kwargs['column'], 'count', fill_value=0))
+                elif function is cohort_student_counts:
+                    counts = connection.execute(
+                        f"SELECT cohort_month, count(DISTINCT student_id) AS student_id FROM {frame} GROUP BY ALL ORDER BY cohort_month"
+                    ).df()
+                    forecast_pivots[name] = counts.set_index(pd.PeriodIndex(counts['cohort_month'], freq='M', name='cohort_month'))['student_id']
+                record['rows_out'] = len(forecast_pivots[name])
+
+        # Pivots without an SQL translation are computed by the pandas reference instead
+        if untranslated:
+            backend_logger.warning('No SQL translation for pivots %s, computed with pandas', ', '.join(untranslated))
+            forecast_pivots.update(PandasBackend().forecast_pivots(data_version, as_of, tuple(untranslated)))
+
+        return {name: forecast_pivots[name] for name in pivots}
+
+
+QUERY_BACKENDS = {'pandas': PandasBackend, 'duckdb': DuckDBBackend}
+
+def get_query_backend(name=None):
+    name = name or QUERY_BACKEND
+    if name not in QUERY_BACKENDS:
+        raise ValueError(f"Unknown query backend {name!r}, expected one of {', '.join(QUERY_BACKENDS)}")
+
+    return QUERY_BACKENDS[name]()
+
+# The Renewals Forecast sections load their pivots one by one: an entry per pivot for every kept day and data version
+@st.cache_data(max_entries=len(FORECAST_PIVOTS) * SNAPSHOT_DAYS * SNAPSHOT_VERSIONS)
+def prepare_forecast_pivots(backend_name, data_version, as_of, names=None):
+    # Pivots kept up to date by utils/ingest.py for this data version and day are read from its aggregates, the
+    # backend only computes the others
+    names = tuple(select_forecast_pivots(names))
+    forecast_pivots = load_ingested_pivots(data_version, as_of)
+    missing = tuple(name for name in names if name not in forecast_pivots)
+    if missing:
+        forecast_pivots.update(get_query_backend(backend_name).forecast_pivots(data_version, as_of, missing))
+
+    return {name: forecast_pivots[name] for name in names}
+
+@instrument
+def load_forecast_pivots(as_of=None, names=None):
+    # names: tuple of FORECAST_PIVOTS entries, only those are computed. Every pivot when None
+    data_version = get_data_version()
+    as_of = as_of or get_current_day()
+    forecast_pivots = load_artifact('forecast_pivots', artifact_inputs(data_version, as_of))
+    if forecast_pivots is not None:
+        return {name: forecast_pivots[name] for name in select_forecast_pivots(names)}
+
+    return prepare_forecast_pivots(QUERY_BACKEND, data_version, as_of, names)
+
+
+def compare_backends(as_of=None, backend_name='duckdb'):
+    # Names of the pivots where the backend differs from the pandas reference
+    as_of = as_of or get_current_day()
+    data_version = get_data_version()
+    reference = PandasBackend().forecast_pivots(data_version, as_of)
+    candidate = get_query_backend(backend_name).forecast_pivots(data_version, as_of)
+
+    mismatches = []
+    for name in FORECAST_PIVOTS:
+        try:
+            if isinstance(reference[name], pd.Series):
+                pd.testing.assert_series_equal(candidate[name], reference[name], check_dtype=False)
+            else:
+                pd.testing.assert_frame_equal(candidate[name], reference[name])
+        except AssertionError:
+            mismatches.append(name)
+
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that a query backend returns the same Renewals Forecast tables as pandas.')
+    parser.add_argument('--backend', default='duckdb', choices=sorted(QUERY_BACKENDS))
+    args = parser.parse_args()
+
+    mismatches = compare_backends(backend_name=args.backend)
+    print(f'{args.backend} matches pandas' if not mismatches else f"Mismatched pivots: {', '.join(mismatches)}")
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
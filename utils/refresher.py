@@ -0,0 +1,86 @@
+import logging
+import os
+import threading
+import time
+
+from utils.data_utils import st, get_current_day, file_data_version, serve_data_version, served_data_version, pin_data_version, prepare_cohort_base
+from utils.kpis import compute_kpi_snapshot
+from utils.financial_metrics import get_fx_version, compute_financial_metrics
+from utils.student_dimensions import prepare_student_dimensions
+from utils.query_backend import QUERY_BACKEND, prepare_forecast_pivots
+from utils.survival_forecast import prepare_survival_forecast
+from utils.filter_cube import prepare_filter_cube
+from utils.cross_filter import prepare_cross_filter
+from utils.trends import prepare_trend_rollups
+from utils.instrumentation import instrument
+
+
+# Seconds between two checks of the data files, 0 disables the refresher (pages then read the files directly)
+REFRESH_INTERVAL = float(os.environ.get('DASHBOARD_REFRESH_INTERVAL', 30))
+
+refresh_logger = logging.getLogger('dashboard.refresh')
+
+
+@instrument
+def warm_snapshot(data_version, as_of):
+    # Every table a first page view computes, through the same cached functions the pages call
+    prepare_cohort_base(data_version)
+    prepare_student_dimensions(data_version)
+    # Dashboard Overview (app.py)
+    compute_kpi_snapshot(data_version)
+    compute_financial_metrics(data_version, get_fx_version())
+    prepare_trend_rollups(data_version)
+    # Renewals Forecast (pages/00 subscriptions_analysis.py): every pivot in one parallel call, the sections then read
+    # their own pivot out of the day's snapshot
+    prepare_forecast_pivots(QUERY_BACKEND, data_version, as_of)
+    prepare_survival_forecast(data_version, as_of)
+    # Filter Viewer (pages/filters.py)
+    prepare_filter_cube(data_version, as_of)
+    prepare_cross_filter(data_version, as_of)
+
+def refresh_snapshot(state):
+    # One check of the files. A new version is prepared once it is seen unchanged on two checks in a row (a copy in
+    # progress keeps changing), then served. A new day is prepared for the version already served.
+    data_version, as_of = file_data_version(), get_current_day()
+    if data_version != served_data_version():
+        if data_version != state.get('seen'):
+            state['seen'] = data_version
+            return
+
+        started_at = time.perf_counter()
+        warm_snapshot(data_version, as_of)
+        # Files replaced again while preparing: the next check starts over with them
+        if file_data_version() != data_version:
+            return
+        serve_data_version(data_version)
+        state['warmed'] = (data_version, as_of)
+        refresh_logger.info('Serving data version %s, prepared in %.1fs', data_version, time.perf_counter() - started_at)
+    elif state.get('warmed') != (data_version, as_of):
+        warm_snapshot(data_version, as_of)
+        state['warmed'] = (data_version, as_of)
+
+def _refresh_loop(interval):
+    state = {'warmed': None, 'seen': None}
+    while True:
+        try:
+            refresh_snapshot(state)
+        except Exception:
+            # Unreadable files (e.g. replaced mid-read) are retried on the next check, the served version stays
+            refresh_logger.exception('Data refresh failed')
+        time.sleep(interval)
+
+@st.cache_resource
+def start_refresher(interval=REFRESH_INTERVAL):
+    # One daemon thread per server process. The files found at startup are served right away
+    if served_data_version() is None:
+        serve_data_version(file_data_version())
+    thread = threading.Thread(target=_refresh_loop, args=(interval,), name='dashboard-refresh', daemon=True)
+    thread.start()
+
+    return thread
+
+def serve_snapshot():
+    # Called at the top of every page: reloads happen in the background, the run reads the version served now
+    if REFRESH_INTERVAL > 0:
+        start_refresher()
+    pin_data_version()
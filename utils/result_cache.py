@@ -0,0 +1,102 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# Tables computed for a selection of filters, shared by every session of the process. The least recently used
+# results are evicted once their estimated size passes the budget.
+RESULT_CACHE_MB = float(os.environ.get('DASHBOARD_RESULT_CACHE_MB', 256))
+
+
+def result_bytes(value):
+    # Estimated in-memory size, strings and categories included
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(result_bytes(key) + result_bytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(result_bytes(item) for item in value)
+
+    return sys.getsizeof(value)
+
+def normalize_params(params):
+    # Same key for the same selection: mappings by name, multiselect lists in any order, empty selections dropped.
+    # Tuples are kept in order
+    if isinstance(params, dict):
+        return tuple(sorted((name, normalize_params(value)) for name, value in params.items() if not _is_empty(value)))
+    if isinstance(params, (list, set, frozenset)):
+        return tuple(sorted({normalize_params(value) for value in params}, key=repr))
+    if isinstance(params, tuple):
+        return tuple(normalize_params(value) for value in params)
+
+    return params
+
+def _is_empty(value):
+    return isinstance(value, (list, tuple, set, frozenset, dict)) and not value
+
+
+class ResultCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_or_compute(self, key, compute):
+        # compute runs outside the lock, concurrent misses on the same key may both compute it
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return self._entries[key][0]
+            self._counters['misses'] += 1
+
+        value = compute()
+        size = result_bytes(value)
+        # Larger than the whole budget: returned without evicting everything else
+        if size > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._counters['evictions'] += 1
+
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_result_cache = ResultCache(int(RESULT_CACHE_MB * 2 ** 20))
+
+
+def cached_result(kind, data_version, params, compute):
+    # Results are shared between sessions without copying, callers must treat them as read-only
+    return _result_cache.get_or_compute((kind, data_version, normalize_params(params)), compute)
+
+def result_cache_stats():
+    return _result_cache.stats()
+
+def clear_result_cache():
+    _result_cache.clear()
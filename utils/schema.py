@@ -0,0 +1,146 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+# In-memory storage of the exported columns, columns not listed keep the parquet dtypes:
+#   category - low-cardinality labels, stored once with integer codes per row
+#   integer  - ids, counters, flags and calendar parts, smallest integer type holding every value
+# Amounts stay float64, float32 totals stop being exact past 2 ** 24.
+STUDENTS_SCHEMA = {
+    'country': 'category',
+    'city': 'category',
+    'timezone': 'category',
+    'language': 'category',
+    'status': 'category',
+    'lost_reason': 'category',
+    'sales_agent': 'category',
+    'retention_owner': 'category',
+    'last_or_current_grade': 'category',
+    'last_or_current_module': 'category',
+    'last_or_current_module_number': 'category',
+    'last_or_current_lesson_number': 'category',
+    'last_or_current_tutor': 'category',
+    'last_or_current_grade_and_module': 'category',
+    'signed_up_free': 'integer',
+    'is_pending': 'integer',
+    'should_renew': 'integer',
+    'created_at_year': 'integer',
+    'created_at_month': 'integer',
+    'first_subscription_activated_at_year': 'integer',
+    'first_subscription_activated_at_month': 'integer',
+    'last_subscription_expired_at_year': 'integer',
+    'last_subscription_expired_at_month': 'integer',
+    'subscriptions_quota_count': 'integer',
+    'freeze_count': 'integer',
+    'admin_freeze_count': 'integer',
+    'reschedule_count': 'integer',
+    'admin_reschedule_count': 'integer',
+    'likes_count': 'integer',
+    'projects_count': 'integer',
+    'badges_count': 'integer',
+    'remaining_sessions_count': 'integer',
+    'last_or_current_subscription_id': 'integer',
+}
+
+SUBSCRIPTIONS_SCHEMA = {
+    'id': 'integer',
+    'currency': 'category',
+    'plan': 'category',
+    'status': 'category',
+    'payment_method': 'category',
+    'payment_provider': 'category',
+    'renewal_type': 'category',
+    'lost_reason': 'category',
+    'sales_agent': 'category',
+    'active_years': 'category',
+    'created_at_year': 'integer',
+    'created_at_month': 'integer',
+    'activated_at_year': 'integer',
+    'activated_at_month': 'integer',
+    'expired_at_year': 'integer',
+    'expired_at_month': 'integer',
+    'refund_at_year': 'integer',
+    'refund_at_month': 'integer',
+    'subscription_duration_days': 'integer',
+    'active_months_count': 'integer',
+    'pending_months_count': 'integer',
+    'months_interval': 'integer',
+    'freeze_count': 'integer',
+    'admin_freeze_count': 'integer',
+    'reschedule_count': 'integer',
+    'admin_reschedule_count': 'integer',
+    'change_tutor_count': 'integer',
+    'admin_change_tutor_count': 'integer',
+    'sessions_per_week_count': 'integer',
+    'remaining_sessions_count': 'integer',
+}
+
+INTEGER_TYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def compact_category(series):
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return series
+
+    return series.astype('category')
+
+def compact_integer(series):
+    # Only when lossless: every value integral and in range, nullable integers when values are missing
+    if pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series):
+        return series
+    values = series.dropna()
+    if values.empty or (values % 1 != 0).any():
+        return series
+
+    for integer_type in INTEGER_TYPES:
+        limits = np.iinfo(integer_type)
+        if limits.min <= values.min() and values.max() <= limits.max:
+            dtype = np.dtype(integer_type).name
+            return series.astype(dtype if len(values) == len(series) else dtype.capitalize())
+
+    return series
+
+COMPACTORS = {
+    'category': compact_category,
+    'integer': compact_integer,
+}
+
+def compact_frame(df, schema):
+    for column, kind in schema.items():
+        if column in df.columns:
+            df[column] = COMPACTORS[kind](df[column])
+
+    return df
+
+
+def memory_report(before_df, after_df):
+    # Bytes per column before and after compaction, strings counted with their payload
+    report = pd.DataFrame({
+        'dtype_before': before_df.dtypes.astype(str),
+        'dtype_after': after_df.dtypes.reindex(before_df.columns).astype(str),
+        'bytes_before': before_df.memory_usage(deep=True, index=False),
+        'bytes_after': after_df.memory_usage(deep=True, index=False).reindex(before_df.columns),
+    })
+    report.loc['TOTAL'] = ['', '', report['bytes_before'].sum(), report['bytes_after'].sum()]
+    report['ratio'] = (report['bytes_before'] / report['bytes_after']).round(2)
+
+    return report.rename_axis('column')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory per column of the exports before and after compaction.')
+    parser.add_argument('--students', default='students_sample.parquet')
+    parser.add_argument('--subscriptions', default='subscriptions_sample.parquet')
+    args = parser.parse_args()
+
+    for path, schema in ((args.students, STUDENTS_SCHEMA), (args.subscriptions, SUBSCRIPTIONS_SCHEMA)):
+        raw_df = pd.read_parquet(path)
+        report = memory_report(raw_df, compact_frame(raw_df.copy(), schema))
+        print(f'\n{path}')
+        print(report.to_string())
+
+
+if __name__ == '__main__':
+    main()
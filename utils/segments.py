@@ -0,0 +1,105 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+# Per-student sequence kernels. Rows are sorted once so every student is a contiguous segment, then first / last /
+# previous value / position / rank within a student are array operations over the segment boundaries instead of
+# one hash groupby each. Kernel inputs and outputs are in the sorted row order.
+
+@dataclass(frozen=True)
+class Segments:
+    order: np.ndarray      # original row positions in sorted order
+    starts: np.ndarray     # sorted position of the first row of every segment
+    lengths: np.ndarray    # rows per segment
+    positions: np.ndarray  # position of every sorted row within its segment (cumcount)
+
+    @property
+    def ends(self):
+        return self.starts + self.lengths - 1
+
+
+def sort_key(values):
+    # int64 (or float) key that orders like sort_values, missing values last
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy().astype('int64')
+        return np.where(codes < 0, np.iinfo('int64').max, codes)
+    if values.dtype.kind == 'M' or isinstance(values.dtype, pd.DatetimeTZDtype):
+        keys = values.array.asi8.copy()
+        keys[values.isna().to_numpy()] = np.iinfo('int64').max
+        return keys
+    if values.dtype.kind in 'iub':
+        return values.to_numpy()
+    if values.dtype.kind == 'f':
+        return np.where(np.isnan(values.to_numpy()), np.inf, values.to_numpy())
+
+    codes, _ = pd.factorize(values, sort=True)
+    return np.where(codes < 0, len(codes), codes)
+
+def _sorted_segments(order, sorted_keys):
+    is_start = np.empty(len(order), dtype=bool)
+    is_start[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=is_start[1:])
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, len(order)))
+
+    return Segments(order, starts, lengths, np.arange(len(order)) - np.repeat(starts, lengths))
+
+def sort_segments(keys, *order_by):
+    # One stable sort by keys then each order_by column, ties keep the original row order
+    codes = sort_key(keys)
+    order = np.lexsort([sort_key(column) for column in reversed(order_by)] + [codes])
+
+    return _sorted_segments(order, codes[order])
+
+def contiguous_segments(keys):
+    # Rows already sorted by keys (a frame that went through sort_segments), only the boundaries are found
+    return _sorted_segments(np.arange(len(keys)), keys.to_numpy())
+
+def group_codes(columns, names):
+    # Dense code of every distinct combination of the columns in sorted order, and the combinations as a MultiIndex.
+    # Each column is factorized on its own and the codes are combined as integers, no tuples are built.
+    factorized = [pd.factorize(column, sort=True, use_na_sentinel=False) for column in columns]
+    # Categorical labels back to plain values for display
+    factorized = [(codes, labels.astype(object) if isinstance(labels.dtype, pd.CategoricalDtype) else labels) for codes, labels in factorized]
+    combined = np.zeros(len(columns[0]), dtype='int64')
+    for codes, labels in factorized:
+        combined = combined * len(labels) + codes
+    unique, codes = np.unique(combined, return_inverse=True)
+
+    level_codes = []
+    for _, labels in reversed(factorized):
+        level_codes.insert(0, unique % len(labels))
+        unique = unique // len(labels)
+
+    return codes, pd.MultiIndex.from_arrays([labels.take(level) for (_, labels), level in zip(factorized, level_codes)], names=names)
+
+
+def segment_broadcast(segments, values, rows):
+    # Value at one sorted row per segment, repeated over the whole segment
+    return values.take(np.repeat(rows, segments.lengths)).set_axis(values.index)
+
+def segment_shift(segments, values, periods=1):
+    # Previous (or next, periods < 0) value within the segment, missing at the segment edges
+    shifted = values.shift(periods)
+    if periods >= 0:
+        return shifted.where(segments.positions >= periods)
+
+    return shifted.where(np.repeat(segments.lengths, segments.lengths) - segments.positions > -periods)
+
+def segment_rank(segments, values):
+    # 0-based position of every row when its segment is ordered by values, ties by original row order
+    keys = sort_key(values)
+    same_segment = segments.positions[1:] > 0
+    ordered = (keys[1:] > keys[:-1]) | ((keys[1:] == keys[:-1]) & (segments.order[1:] > segments.order[:-1]))
+    # Rows usually already follow values within each segment, then the rank is the position
+    if np.all(ordered | ~same_segment):
+        return segments.positions
+
+    segment_ids = np.repeat(np.arange(len(segments.starts)), segments.lengths)
+    ranked = np.lexsort((segments.order, keys, segment_ids))
+    ranks = np.empty(len(ranked), dtype='int64')
+    ranks[ranked] = segments.positions
+
+    return ranks
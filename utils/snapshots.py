@@ -0,0 +1,50 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+# Results per cut-off day, shared by every session of the process. The least recently used days are evicted first.
+SNAPSHOT_DAYS = int(os.environ.get('DASHBOARD_SNAPSHOT_DAYS', 7))
+# Data versions kept per kind: the one being served and the one the background refresher is preparing
+SNAPSHOT_VERSIONS = 2
+
+_lock = threading.Lock()
+_snapshots = {}
+
+
+def daily_snapshot(kind, data_version, as_of, build, update=None):
+    # build(as_of) computes a snapshot from scratch. update(previous_as_of, previous, as_of) derives it from the
+    # closest earlier snapshot, so rolling over to a new day only processes the rows that entered since.
+    with _lock:
+        # Snapshots of older data files are dropped
+        versions = _snapshots.setdefault(kind, {})
+        if data_version not in versions:
+            versions[data_version] = OrderedDict()
+            for old_version in list(versions)[:max(len(versions) - SNAPSHOT_VERSIONS, 0)]:
+                del versions[old_version]
+        days = versions[data_version]
+        if as_of in days:
+            days.move_to_end(as_of)
+            return days[as_of]
+        earlier_days = [day for day in days if day < as_of]
+        previous_as_of = max(earlier_days) if earlier_days else None
+        previous = days.get(previous_as_of)
+
+    snapshot = update(previous_as_of, previous, as_of) if update is not None and previous_as_of is not None else build(as_of)
+
+    with _lock:
+        if _snapshots.get(kind, {}).get(data_version) is days:
+            days[as_of] = snapshot
+            days.move_to_end(as_of)
+            while len(days) > SNAPSHOT_DAYS:
+                days.popitem(last=False)
+
+    return snapshot
+
+def snapshot_days(kind, data_version):
+    with _lock:
+        return sorted(_snapshots.get(kind, {}).get(data_version, {}))
+
+def clear_snapshots():
+    with _lock:
+        _snapshots.clear()
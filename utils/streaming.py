@@ -0,0 +1,67 @@
+import glob
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils.data_utils import check_data_file
+from utils.task_pool import run_jobs
+
+
+# Enabled with DASHBOARD_STREAMING=1: the overview metrics are folded batch by batch out of the parquet files instead
+# of reading whole tables, memory then stays bounded by the batch size and the partial aggregates
+STREAMING_OVERVIEW = os.environ.get('DASHBOARD_STREAMING', '') not in ('', '0', 'false')
+STREAM_BATCH_ROWS = int(os.environ.get('DASHBOARD_STREAM_BATCH_ROWS', 256_000))
+
+
+def parquet_files(path):
+    # A parquet file, or a directory of parts (e.g. one file per export day) streamed in parallel
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True))
+
+    return [path]
+
+def iter_batches(path, columns, prepare, batch_rows=STREAM_BATCH_ROWS):
+    # Frames of at most batch_rows rows, read row group by row group and prepared like the in-memory tables
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=list(columns)):
+        yield prepare(batch.to_pandas())
+
+def empty_frame(path, columns, prepare):
+    return prepare(pq.read_schema(path).empty_table().select(list(columns)).to_pandas())
+
+def fold_file(path, columns, prepare, partial, merge, batch_rows=STREAM_BATCH_ROWS):
+    # Every batch is reduced to its partial aggregate and merged right away, one batch is held at a time
+    folded = None
+    for frame in iter_batches(path, columns, prepare, batch_rows):
+        batch_partial = partial(frame)
+        folded = batch_partial if folded is None else merge([folded, batch_partial])
+
+    return folded
+
+def stream_aggregate(path, columns, prepare, partial, merge, workers=None, batch_rows=STREAM_BATCH_ROWS):
+    # partial(frame) -> partial aggregate, merge(list of partials) -> partial aggregate. merge must not depend on
+    # how the rows were split, so the files fold on their own threads and their partials are merged at the end.
+    files = parquet_files(path)
+    jobs = {file: (lambda file=file: fold_file(file, columns, prepare, partial, merge, batch_rows)) for file in files}
+    partials = [file_partial for file_partial in run_jobs(jobs, workers).values() if file_partial is not None]
+    if not partials:
+        return partial(empty_frame(files[0], columns, prepare))
+
+    return partials[0] if len(partials) == 1 else merge(partials)
+
+def stream_data_file(data_version, position, columns, prepare, partial, merge, workers=None, batch_rows=STREAM_BATCH_ROWS):
+    # stream_aggregate over a file of the data version, which must stay unchanged until the last batch is folded
+    folded = stream_aggregate(check_data_file(data_version, position), columns, prepare, partial, merge, workers, batch_rows)
+    check_data_file(data_version, position)
+
+    return folded
+
+
+def merge_counts(series_list):
+    # Counts (or sums) indexed by their key, added across partials
+    return pd.concat(series_list).groupby(level=0, sort=True).sum()
+
+def merge_distinct(frames):
+    # Distinct keys (e.g. student ids) kept across partials, the size follows the distinct keys and not the rows
+    return pd.concat(frames, ignore_index=True).drop_duplicates(ignore_index=True)
@@ -0,0 +1,34 @@
+from utils.data_utils import st, pd, np, read_students
+from utils.instrumentation import instrument
+
+
+STUDENT_DIMENSIONS = ['country', 'last_or_current_grade_and_module', 'last_or_current_tutor', 'lost_reason']
+
+
+@instrument
+def build_student_dimensions(students_df, columns=STUDENT_DIMENSIONS):
+    # student_id -> dense position, and every attribute as integer codes aligned on those positions (-1 for missing)
+    dimensions = {'index': pd.Index(students_df['id']), 'codes': {}, 'categories': {}}
+    for column in columns:
+        categorical = pd.Categorical(students_df[column])
+        dimensions['codes'][column] = categorical.codes
+        dimensions['categories'][column] = categorical.categories
+
+    return dimensions
+
+@st.cache_resource(max_entries=2)
+def prepare_student_dimensions(data_version):
+    students_df = read_students(data_version, ('id',) + tuple(STUDENT_DIMENSIONS))
+
+    return build_student_dimensions(students_df)
+
+
+def student_positions(dimensions, student_ids):
+    # -1 for ids missing from the students table
+    return dimensions['index'].get_indexer(student_ids)
+
+def gather_dimension(dimensions, column, positions):
+    # Attribute values for each position as a categorical, without joining on the string ids
+    codes = np.where(positions >= 0, dimensions['codes'][column][positions], -1)
+
+    return pd.Categorical.from_codes(codes, dimensions['categories'][column])
@@ -0,0 +1,150 @@
+from utils.data_utils import st, pd, np, get_data_version, get_current_day, prepare_cohort_base
+from utils.segments import contiguous_segments, group_codes
+from utils.artifacts import artifact_inputs, load_artifact
+from utils.instrumentation import instrument
+
+
+# Students are grouped by the month and the plan/currency of their first subscription
+SURVIVAL_SEGMENTS = ['plan', 'currency']
+FORECAST_HORIZON = 12
+
+# Hazards of a cohort x segment with fewer students at risk fall back to its segment over all cohorts, then to everyone
+MIN_AT_RISK = 10
+
+
+def months_between(start, end):
+    # Same month count as the cohort pivots
+    return ((end - start).dt.days / 30).round()
+
+@instrument
+def survival_subjects(subscriptions_df, as_of, segments=SURVIVAL_SEGMENTS):
+    # One row per student: months followed since the first subscription, churned or censored at as_of.
+    # subscriptions_df is the total subscriptions frame of the cohort base, sorted by student and expiry and numbered.
+    subscriptions_df = subscriptions_df[(subscriptions_df['created_at'] < as_of).to_numpy()]
+    student_segments = contiguous_segments(subscriptions_df['student_id'])
+
+    first = subscriptions_df[(subscriptions_df['subscription_count'] == 0).to_numpy()]
+    last_expired_at = subscriptions_df['expired_at'].take(student_segments.ends)
+
+    # Students whose last subscription already ended have churned, the others are still followed at as_of
+    churned = (last_expired_at < as_of).to_numpy()
+    ended_at = last_expired_at.where(churned, as_of).set_axis(first.index)
+
+    subjects = first[['student_id'] + segments].reset_index(drop=True)
+    subjects['cohort_month'] = first['created_at'].dt.to_period('M').array
+    subjects['months'] = months_between(first['created_at'], ended_at).astype('int64').to_numpy()
+    subjects['churned'] = churned
+
+    return subjects
+
+def kaplan_meier_hazards(groups, n_groups, months, churned, n_months):
+    # Monthly churn hazard and students at risk of every group, all groups at once: (n_groups, n_months) matrices
+    cells = groups * n_months + months
+    exits = np.bincount(cells, minlength=n_groups * n_months).reshape(n_groups, n_months)
+    events = np.bincount(cells, weights=churned, minlength=n_groups * n_months).reshape(n_groups, n_months)
+    at_risk = exits[:, ::-1].cumsum(axis=1)[:, ::-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hazards = events / at_risk
+
+    return hazards, at_risk
+
+def blend_hazards(hazards, at_risk, fallback):
+    return np.where(at_risk >= MIN_AT_RISK, hazards, fallback)
+
+def survival_from_hazards(hazards):
+    # Column t is the share of students still subscribed after t months
+    return np.cumprod(1 - hazards, axis=1)
+
+@instrument
+def order_values(subscriptions_df, as_of, segments=SURVIVAL_SEGMENTS):
+    # Average paid amount and length of a subscription per segment, from the subscriptions created before as_of
+    subscriptions_df = subscriptions_df[(subscriptions_df['created_at'] < as_of).to_numpy()]
+    values = subscriptions_df[segments + ['paid_amount']].assign(
+        subscription_months=months_between(subscriptions_df['created_at'], subscriptions_df['expired_at']).clip(lower=1)
+    )
+    values = values.groupby(segments, observed=True).agg(
+        aov=('paid_amount', 'mean'),
+        subscription_months=('subscription_months', 'mean'),
+        subscriptions=('paid_amount', 'size'),
+    )
+    values.index = pd.MultiIndex.from_arrays([values.index.get_level_values(column).astype(object) for column in segments], names=segments)
+
+    return values
+
+@instrument
+def build_survival_forecast(subscriptions_df, as_of, segments=SURVIVAL_SEGMENTS, horizon=FORECAST_HORIZON):
+    subjects = survival_subjects(subscriptions_df, as_of, segments)
+    values = order_values(subscriptions_df, as_of, segments)
+
+    # Codes of every student's cohort x segment, of every group's segment over all cohorts, and of the cohorts alone
+    subject_groups, groups = group_codes([subjects[column] for column in ['cohort_month'] + segments], ['cohort_month'] + segments)
+    segment_codes, segment_labels = group_codes([groups.get_level_values(column) for column in segments], segments)
+    cohort_codes, cohort_labels = pd.factorize(subjects['cohort_month'], sort=True)
+
+    months, churned = subjects['months'].to_numpy(), subjects['churned'].to_numpy()
+    n_months = months.max() + horizon + 1 if len(months) else horizon + 1
+    subject_segments = segment_codes[subject_groups]
+
+    # Beyond the months with enough students at risk the overall hazard keeps its last value
+    overall, overall_at_risk = kaplan_meier_hazards(np.zeros(len(months), dtype='int64'), 1, months, churned, n_months)
+    last_observed = np.maximum.accumulate(np.where(overall_at_risk[0] >= MIN_AT_RISK, np.arange(n_months), 0))
+    overall = np.nan_to_num(overall[:, last_observed])
+    segment_hazards, segment_at_risk = kaplan_meier_hazards(subject_segments, len(segment_labels), months, churned, n_months)
+    segment_hazards = blend_hazards(segment_hazards, segment_at_risk, overall)
+    group_hazards, group_at_risk = kaplan_meier_hazards(subject_groups, len(groups), months, churned, n_months)
+    group_survival = survival_from_hazards(blend_hazards(group_hazards, group_at_risk, segment_hazards[segment_codes]))
+
+    # Students still subscribed at as_of, counted per group and month of follow-up
+    active = np.bincount(subject_groups[~churned] * n_months + months[~churned], minlength=len(groups) * n_months).reshape(len(groups), n_months)
+    expected_active = np.empty((len(groups), horizon))
+    followed = n_months - horizon
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for ahead in range(1, horizon + 1):
+            # Probability to still be subscribed `ahead` months later, given subscribed now
+            retained = np.nan_to_num(group_survival[:, ahead:ahead + followed] / group_survival[:, :followed])
+            expected_active[:, ahead - 1] = (active[:, :followed] * retained).sum(axis=1)
+
+    # Every month a student stays, 1 / subscription length of a renewal at the segment's average order value
+    group_values = values.reindex(groups.droplevel('cohort_month'))
+    renewal_rate = (1 / group_values['subscription_months']).fillna(0).to_numpy()[:, None]
+    months_ahead = pd.RangeIndex(1, horizon + 1, name='months_ahead')
+    expected_renewals = expected_active * renewal_rate
+
+    # Retention curves per cohort over all segments, shown up to the months each cohort could be followed
+    cohort_hazards, cohort_at_risk = kaplan_meier_hazards(cohort_codes, len(cohort_labels), months, churned, n_months)
+    cohort_survival = survival_from_hazards(blend_hazards(cohort_hazards, cohort_at_risk, overall))
+    cohort_reach = np.zeros(len(cohort_labels), dtype='int64')
+    np.maximum.at(cohort_reach, cohort_codes, months)
+    survival = pd.DataFrame(
+        np.where(np.arange(n_months) <= cohort_reach[:, None], cohort_survival, np.nan)[:, :followed],
+        index=pd.PeriodIndex(cohort_labels, name='cohort_month'),
+        columns=pd.RangeIndex(followed, name='months_count_from_subscription'),
+    ).dropna(axis=1, how='all')
+
+    return {
+        'survival': survival,
+        'order_values': values,
+        'active': pd.DataFrame(expected_active, index=groups, columns=months_ahead),
+        'renewals': pd.DataFrame(expected_renewals, index=groups, columns=months_ahead),
+        'revenue': pd.DataFrame(expected_renewals * group_values['aov'].fillna(0).to_numpy()[:, None], index=groups, columns=months_ahead),
+    }
+
+@st.cache_data(max_entries=4)
+def prepare_survival_forecast(data_version, as_of, horizon=FORECAST_HORIZON):
+    (subscriptions_df, _), _, _ = prepare_cohort_base(data_version)
+
+    return build_survival_forecast(subscriptions_df, as_of, horizon=horizon)
+
+@instrument
+def load_survival_forecast(as_of=None):
+    data_version = get_data_version()
+    as_of = as_of or get_current_day()
+    survival_forecast = load_artifact('survival_forecast', artifact_inputs(data_version, as_of))
+
+    return survival_forecast if survival_forecast is not None else prepare_survival_forecast(data_version, as_of)
+
+
+def forecast_by(table, level):
+    # Expected values per future month, summed over every cohort and the other segments
+    return table.groupby(level=level).sum()
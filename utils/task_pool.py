@@ -0,0 +1,26 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.instrumentation import profiled_task, adopt_profile_records
+
+
+# Worker threads for independent jobs, 1 runs them one after the other on the calling thread
+TASK_WORKERS = int(os.environ.get('DASHBOARD_WORKERS', min(8, os.cpu_count() or 1)))
+
+
+def run_jobs(jobs, workers=None):
+    # jobs: name -> zero-argument callable, none of them depends on another. Results keep the order of the jobs.
+    # Threads share the prepared frames without copying them, pandas releases the GIL in its grouping and sorting kernels.
+    workers = TASK_WORKERS if workers is None else workers
+    if workers <= 1 or len(jobs) <= 1:
+        return {name: job() for name, job in jobs.items()}
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs)), thread_name_prefix='dashboard-job') as executor:
+        futures = {name: executor.submit(profiled_task(job)) for name, job in jobs.items()}
+
+        results = {}
+        for name, future in futures.items():
+            results[name], records = future.result()
+            adopt_profile_records(records)
+
+    return results
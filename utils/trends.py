@@ -0,0 +1,285 @@
+from datetime import date
+
+from pandas.tseries.offsets import DateOffset
+
+from utils.data_utils import st, pd, np, alt, cairo, STUDENTS_FILE, SUBSCRIPTIONS_FILE, read_students, read_subscriptions, prepare_students_frame, prepare_subscriptions_frame, get_data_version, currency_symbol
+from utils.financial_metrics import AMOUNT_COLUMNS
+from utils.segments import sort_segments, contiguous_segments, segment_shift
+from utils.streaming import STREAMING_OVERVIEW, stream_data_file
+from utils.artifacts import artifact_inputs, load_artifact
+from utils.result_cache import cached_result
+from utils.instrumentation import instrument, profile_stage
+
+
+# Daily rollups behind every trend chart of the overview, any granularity and date range is rolled up from them:
+#   revenue        amounts per (currency, day): paid / remaining / refund by creation day, refunded by refund day
+#   registrations  students registered (and free) per day
+#   active         active days of every student up to the export day, merged into disjoint [start, end] day ranges
+#                  (days since 1970-01-01)
+TREND_STUDENT_COLUMNS = ('id', 'created_at', 'signed_up_free')
+TREND_SUBSCRIPTION_COLUMNS = ('student_id', 'currency', 'created_at', 'activated_at', 'expired_at', 'refund_at') + tuple(AMOUNT_COLUMNS)
+
+# Granularity -> (pandas period frequency, date format of the chart axis and tooltips)
+GRANULARITIES = {
+    'Week': ('W-SUN', '%d %b %Y'),
+    'Month': ('M', '%b %Y'),
+    'Quarter': ('Q-DEC', 'Q%q %Y'),
+    'Year': ('Y-DEC', '%Y'),
+}
+GRANULARITY_ADJECTIVES = {'Week': 'Weekly', 'Month': 'Monthly', 'Quarter': 'Quarterly', 'Year': 'Yearly'}
+
+REVENUE_TRENDS = ['Total Revenue', 'Net Revenue', 'Refund Amount']
+USER_TRENDS = ['Total Registered Students', 'Active Students', 'Free Registered Students']
+
+
+def local_days(timestamps):
+    # Calendar day in Cairo, as midnight timestamps without a time zone
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_convert(cairo).dt.tz_localize(None)
+
+    return timestamps.dt.normalize()
+
+def day_numbers(days):
+    return days.to_numpy().astype('datetime64[D]').astype('int64')
+
+
+# --- Partial rollups, the rollups of separate batches merge into those of all their rows ---
+
+def revenue_partial(subscriptions_df):
+    currencies = subscriptions_df['currency'].astype(object)
+    created = subscriptions_df[AMOUNT_COLUMNS].groupby([currencies, local_days(subscriptions_df['created_at'])]).sum()
+    refunded = subscriptions_df['refund_amount'].groupby([currencies, local_days(subscriptions_df['refund_at'])]).sum()
+
+    return merge_revenue_partials([created, refunded.to_frame('refunded')])
+
+def merge_revenue_partials(partials):
+    revenue = pd.concat(partials).fillna(0).groupby(level=[0, 1]).sum()
+
+    return revenue.reindex(columns=AMOUNT_COLUMNS + ['refunded'], fill_value=0).rename_axis(['currency', 'day'])
+
+def registrations_partial(students_df):
+    return pd.DataFrame({
+        'registered': students_df['id'].notna().astype('int64'),
+        'registered_free': (students_df['signed_up_free'] == 1).astype('int64'),
+    }).groupby(local_days(students_df['created_at']).rename('day')).sum()
+
+def merge_registrations_partials(partials):
+    return pd.concat(partials).groupby(level=0).sum()
+
+def merge_intervals(intervals):
+    # Overlapping or touching day ranges of a student become one range, sorted by student and start
+    segments = sort_segments(intervals['student_id'], intervals['start'])
+    intervals = intervals.take(segments.order).reset_index(drop=True)
+    segment_ids = np.repeat(np.arange(len(segments.starts)), segments.lengths)
+    reach = intervals['end'].groupby(segment_ids).cummax()
+    opens = (intervals['start'] > segment_shift(segments, reach) + 1) | (segments.positions == 0)
+
+    merged = intervals.groupby(opens.cumsum().to_numpy(), sort=False).agg(student_id=('student_id', 'first'), start=('start', 'min'), end=('end', 'max'))
+
+    return merged.reset_index(drop=True)
+
+def active_partial(subscriptions_df):
+    # Same subscriptions as the yearly active students: active from activation to expiry, unless it ran over 18 months
+    subscriptions_df = subscriptions_df[
+        (subscriptions_df['expired_at'] < subscriptions_df['activated_at'] + DateOffset(months=18)).to_numpy()
+    ]
+
+    return merge_intervals(pd.DataFrame({
+        'student_id': subscriptions_df['student_id'].to_numpy(),
+        'start': day_numbers(local_days(subscriptions_df['activated_at'])),
+        'end': day_numbers(local_days(subscriptions_df['expired_at'])),
+    }))
+
+def merge_active_partials(partials):
+    return merge_intervals(pd.concat(partials, ignore_index=True))
+
+def export_day(revenue, registrations):
+    # Last day with a registration, a subscription or a refund, None for an empty export
+    days = revenue.index.get_level_values('day').append(registrations.index)
+
+    return day_numbers(days).max() if len(days) else None
+
+def finish_active(intervals, last_day):
+    # Activity stops at the export day, like the active_years column of the export: subscriptions paid beyond it
+    # (or scheduled to start after it) count up to that day. Ranges cut on the same day are merged again
+    if last_day is not None:
+        intervals = merge_intervals(intervals.assign(start=intervals['start'].clip(upper=last_day), end=intervals['end'].clip(upper=last_day)))
+    # The end of the student's previous range (-1 for the first one) replaces the student id
+    previous_end = segment_shift(contiguous_segments(intervals['student_id']), intervals['end'])
+
+    return pd.DataFrame({
+        'start': intervals['start'].to_numpy(),
+        'end': intervals['end'].to_numpy(),
+        'previous_end': previous_end.fillna(-1).astype('int64').to_numpy(),
+    })
+
+
+@instrument
+def build_trend_rollups(students_df, subscriptions_df):
+    revenue, registrations = revenue_partial(subscriptions_df), registrations_partial(students_df)
+
+    return {
+        'revenue': revenue,
+        'registrations': registrations,
+        'active': finish_active(active_partial(subscriptions_df), export_day(revenue, registrations)),
+    }
+
+@instrument
+def stream_trend_rollups(data_version):
+    revenue = stream_data_file(data_version, SUBSCRIPTIONS_FILE, TREND_SUBSCRIPTION_COLUMNS, prepare_subscriptions_frame, revenue_partial, merge_revenue_partials)
+    registrations = stream_data_file(data_version, STUDENTS_FILE, TREND_STUDENT_COLUMNS, prepare_students_frame, registrations_partial, merge_registrations_partials)
+    active = stream_data_file(data_version, SUBSCRIPTIONS_FILE, TREND_SUBSCRIPTION_COLUMNS, prepare_subscriptions_frame, active_partial, merge_active_partials)
+
+    return {'revenue': revenue, 'registrations': registrations, 'active': finish_active(active, export_day(revenue, registrations))}
+
+@st.cache_data(max_entries=2)
+def prepare_trend_rollups(data_version):
+    if STREAMING_OVERVIEW:
+        return stream_trend_rollups(data_version)
+    students_df = read_students(data_version, TREND_STUDENT_COLUMNS)
+    subscriptions_df = read_subscriptions(data_version, TREND_SUBSCRIPTION_COLUMNS)
+
+    return build_trend_rollups(students_df, subscriptions_df)
+
+@instrument
+def load_trend_rollups():
+    data_version = get_data_version()
+    trend_rollups = load_artifact('trend_rollups', artifact_inputs(data_version))
+
+    return trend_rollups if trend_rollups is not None else prepare_trend_rollups(data_version)
+
+
+# --- Roll-ups to a granularity and date range ---
+
+def trend_date_range(trend_rollups):
+    # Every day of the rollups, active ranges end on the export day at the latest
+    active_days = pd.DatetimeIndex(np.concatenate([trend_rollups['active']['start'], trend_rollups['active']['end']]).astype('datetime64[D]'))
+    days = trend_rollups['revenue'].index.get_level_values('day').append([trend_rollups['registrations'].index, active_days])
+    if days.empty:
+        return date.today(), date.today()
+
+    return days.min().date(), days.max().date()
+
+def period_index(days, granularity):
+    return pd.DatetimeIndex(days).to_period(GRANULARITIES[granularity][0])
+
+def _in_range(days, start, end):
+    return (days >= pd.Timestamp(start)) & (days <= pd.Timestamp(end))
+
+@instrument
+def roll_up_revenue(trend_rollups, currency, granularity, start, end):
+    revenue = trend_rollups['revenue']
+    revenue = revenue.loc[revenue.index.get_level_values('currency') == currency].droplevel('currency')
+    revenue = revenue.loc[_in_range(revenue.index, start, end)]
+    revenue = revenue.groupby(period_index(revenue.index, granularity)).sum()
+
+    # Revenue follows the creation day, refunds the day they were paid back
+    return pd.DataFrame({
+        'Total Revenue': revenue['paid_amount'] + revenue['remaining_amount'],
+        'Net Revenue': revenue['paid_amount'] - revenue['refund_amount'],
+        'Refund Amount': revenue['refunded'],
+    }).rename_axis('Period')
+
+def count_active(active, granularity, start, end):
+    # Distinct students active in every period: +1 at the first and -1 after the last period of every range.
+    # Ranges are disjoint per student, a range opening in the period where the student's previous one closed
+    # is not counted twice there.
+    start_day, end_day = (pd.Timestamp(day).to_datetime64().astype('datetime64[D]').astype('int64') for day in (start, end))
+    active = active[((active['end'] >= start_day) & (active['start'] <= end_day)).to_numpy()]
+    if active.empty:
+        return pd.Series(dtype='int64')
+
+    # Period of every day of the span, looked up by day instead of converting every range end
+    first_day = min(start_day, active['start'].min())
+    span = np.arange(first_day, max(end_day, active['end'].max()) + 1)
+    span_periods = period_index(span.astype('datetime64[D]'), granularity).asi8
+
+    def periods(days):
+        return span_periods[days - first_day]
+
+    first_periods = periods(active['start'].clip(lower=start_day).to_numpy())
+    last_periods = periods(active['end'].clip(upper=end_day).to_numpy())
+    previous_end = active['previous_end'].to_numpy()
+    continued = (previous_end >= start_day) & (periods(np.maximum(previous_end, start_day)) == first_periods)
+
+    offset = first_periods.min()
+    size = last_periods.max() - offset + 2
+    changes = (
+        np.bincount(first_periods - offset, minlength=size) - np.bincount(last_periods - offset + 1, minlength=size)
+        - np.bincount(first_periods[continued] - offset, minlength=size) + np.bincount(first_periods[continued] - offset + 1, minlength=size)
+    )
+    counts = np.cumsum(changes)[:-1]
+    ordinals = np.arange(offset, offset + size - 1)
+
+    return pd.Series(counts, index=pd.PeriodIndex.from_ordinals(ordinals, freq=GRANULARITIES[granularity][0]))
+
+@instrument
+def roll_up_users(trend_rollups, granularity, start, end):
+    registrations = trend_rollups['registrations']
+    registrations = registrations.loc[_in_range(registrations.index, start, end)]
+    registrations = registrations.groupby(period_index(registrations.index, granularity)).sum()
+    active = count_active(trend_rollups['active'], granularity, start, end)
+
+    return pd.DataFrame({
+        'Total Registered Students': registrations['registered'],
+        'Active Students': active[active > 0],
+        'Free Registered Students': registrations['registered_free'],
+    }).fillna(0).astype('int64').rename_axis('Period')
+
+def load_revenue_trend(trend_rollups, currency, granularity, start, end):
+    params = {'currency': currency, 'granularity': granularity, 'start': start, 'end': end}
+    return cached_result('revenue_trend', get_data_version(), params, lambda: roll_up_revenue(trend_rollups, currency, granularity, start, end))
+
+def load_user_trend(trend_rollups, granularity, start, end):
+    params = {'granularity': granularity, 'start': start, 'end': end}
+    return cached_result('user_trend', get_data_version(), params, lambda: roll_up_users(trend_rollups, granularity, start, end))
+
+
+# --- Charts ---
+
+def trend_chart(trend, granularity, value_title, value_format):
+    # The payload is one row per period with a column per category, Vega folds and formats it in the browser
+    date_format = GRANULARITIES[granularity][1]
+    categories = list(trend.columns)
+    payload = trend.set_axis(trend.index.to_timestamp(), axis=0).rename_axis('Period').reset_index()
+    selection = alt.selection_point(fields=['Category'], bind='legend', empty='all')
+
+    return alt.Chart(payload).transform_fold(categories, as_=['Category', 'Value']).mark_line(point=True).encode(
+        x=alt.X('Period:T', title=granularity, axis=alt.Axis(format=date_format)),
+        y=alt.Y('Value:Q', title=value_title),
+        color=alt.Color('Category:N', title="Category", sort=categories,
+                        legend=alt.Legend(labelFontSize=12, labelFont='Arial', labelLimit=200, titlePadding=15)),
+        tooltip=[
+            alt.Tooltip('Period:T', title=granularity, format=date_format),
+            alt.Tooltip('Category:N'),
+            alt.Tooltip('Value:Q', title=value_title, format=value_format),
+        ],
+        opacity=alt.condition(selection, alt.value(1), alt.value(0.3))
+    ).add_params(selection)
+
+def plot_revenue_trends(revenue_trend, currency, granularity):
+    symbol = currency_symbol(currency)
+    currency = currency.upper()
+
+    st.subheader(f"📈 {currency}: {GRANULARITY_ADJECTIVES[granularity]} Revenue Trends")
+    st.markdown(f"""
+    This chart shows the {GRANULARITY_ADJECTIVES[granularity].lower()} trends for **{currency} transactions only**:
+    - 💰 Total Revenue
+    - 📊 Net Revenue
+    - ↪️ Refund Amount
+    """)
+
+    with profile_stage('render.revenue_trend_chart', len(revenue_trend)):
+        st.altair_chart(trend_chart(revenue_trend, granularity, f"Amount ({symbol})", ',.0f'), use_container_width=True)
+
+def plot_user_trends(user_trend, granularity):
+    st.subheader(f"📊 User Trends - {GRANULARITY_ADJECTIVES[granularity]}")
+    st.markdown("""
+    This chart shows the trends for users:
+    - 📈 Total Registered Users
+    - 🔥 Active Users
+    - 🚀 Free Registered Users
+    """)
+
+    with profile_stage('render.user_trend_chart', len(user_trend)):
+        st.altair_chart(trend_chart(user_trend, granularity, "Count", ',.0f'), use_container_width=True)